@@ -1,321 +1,4420 @@
 #!/bin/python
 
+import time
+
+# Taken before anything else is imported, for the time to first frame.
+STARTED = time.monotonic()
+
+import array
+import bisect
+import collections
+import csv
 import curses
+import importlib
+import io
+import json
+import locale
+import math
+import operator
+import mmap
 import optparse
+import os
+import random
+import re
 import select
+import signal
+import socket
+import socketserver
+import struct
 import sys
+import threading
+import types
+import zlib
 import errno
-import beanstalkc
+import fnmatch
+import heapq
+
+
+
+class LazyModule(object):
+    """
+    Imports the module `name` the first time one of its attributes is
+    used, so that getting a first frame on screen doesn't wait for
+    modules only collecting, or a mode never used, needs.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+
+asyncio = LazyModule('asyncio')
+beanstalkc = LazyModule('beanstalkc')
+futures = LazyModule('concurrent.futures')
+subprocess = LazyModule('subprocess')
+
+
+RECONNECT_BACKOFF_MIN = 0.5
+RECONNECT_BACKOFF_MAX = 30.0
+
+# Keep each pipelined write well inside the socket buffers so we never
+# block sending while the server is blocked sending replies to us.
+PIPELINE_BATCH_SIZE = 500
+
+# (rate key, server-wide counter, per-tube counter). stats-tube has no
+# bury counter, so tubes only get put and delete rates.
+RATE_COUNTERS = (
+    ('put-rate', 'cmd-put', 'total-jobs'),
+    ('delete-rate', 'cmd-delete', 'cmd-delete'),
+    ('bury-rate', 'cmd-bury', None),
+    )
+
+# Seconds over which a tube's put and delete rates are smoothed into
+# the arrival and completion rates its drain ETA is forecast from, and
+# the smoothed rate below which a tube counts as idle.
+FORECAST_WINDOW = 60.0
+FORECAST_MIN_RATE = 0.01
+
+# The ETA of a tube taking on jobs faster than it completes them.
+GROWING = 'growing'
+
+NUMERIC_COLUMN_WIDTH = 10
+
+# (row key, title) for each table column, in display order.
+COLUMNS = (
+    ('name', 'TUBE'),
+    ('current-jobs-ready', 'READY'),
+    ('current-jobs-urgent', 'URGENT'),
+    ('current-jobs-reserved', 'RESRVD'),
+    ('current-jobs-delayed', 'DELAYD'),
+    ('current-jobs-buried', 'BURIED'),
+    ('put-rate', 'PUT/s'),
+    ('delete-rate', 'DEL/s'),
+    ('bury-rate', 'BURY/s'),
+    ('eta', 'ETA'),
+    ('trend', 'TREND'),
+    )
+
+SUMMARY_ITEMS = (
+    'PID: {pid}',
+    'Uptime: {uptime}',
+    'Total Jobs: {total-jobs}',
+    'Connections: {current-connections} ({current-producers}:{current-workers})',
+    'Cur. Tubes: {current-tubes}',
+    'Cur. Ready: {current-jobs-ready}',
+    'Cur. Urgent: {current-jobs-urgent}',
+    'Cur. Buried: {current-jobs-buried}',
+    'Cur. Reserved: {current-jobs-reserved}',
+    'Put/s: {put-rate}',
+    'Delete/s: {delete-rate}',
+    'Bury/s: {bury-rate}',
+    'Status: {status}',
+    )
+
+SORTABLE_COLUMNS = tuple(column for column, _ in COLUMNS if column != 'trend')
+
+# The numeric per-row fields written out in batch mode.
+RECORD_FIELDS = tuple(column for column, _ in COLUMNS if column not in ('name', 'trend'))
+
+# The per-tube values a TubeTable keeps, and those of them shown as
+# floats rather than whole numbers.
+TABLE_COLUMNS = RECORD_FIELDS + ('refreshed-at',)
+FLOAT_COLUMNS = frozenset([rate for rate, _, _ in RATE_COUNTERS] + ['refreshed-at'])
+
+NAN = float('nan')
+INFINITY = float('inf')
+NAN_BYTES = struct.pack('d', NAN)
+
+# TubeIds are only thrown away and reissued once they outnumber the
+# tubes in a table by two to one, and never below this many.
+TUBE_IDS_MIN = 1024
+
+# Tubes compared at a time when looking for changes between tables.
+CHANGE_SCAN_BLOCK = 64
+
+# Seconds before an alert rule that fired for a tube may notify about
+# it again, unless the rule sets its own cooldown.
+ALERT_COOLDOWN = 300.0
+
+BATCH_FORMATS = ('text', 'json', 'csv')
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Job states reported by both stats and stats-tube as current-jobs-<state>.
+JOB_STATES = ('ready', 'urgent', 'reserved', 'delayed', 'buried')
+
+# (metric name, type, stats key, help) for the server-wide figures.
+SERVER_METRICS = (
+    ('beanstalkd_uptime_seconds', 'gauge', 'uptime', 'Seconds since the server started.'),
+    ('beanstalkd_current_connections', 'gauge', 'current-connections', 'Open connections.'),
+    ('beanstalkd_current_producers', 'gauge', 'current-producers', 'Connections that have issued a put.'),
+    ('beanstalkd_current_workers', 'gauge', 'current-workers', 'Connections that have issued a reserve.'),
+    ('beanstalkd_current_tubes', 'gauge', 'current-tubes', 'Tubes that currently exist.'),
+    ('beanstalkd_jobs', 'counter', 'total-jobs', 'Jobs created since the server started.'),
+    )
+
+# Shown in place of real figures until a server has been reached.
+DEFAULT_OVERVIEW = dict(
+    (i, '-') for i in (
+        'pid',
+        'total-jobs',
+        'current-connections',
+        'current-producers',
+        'current-workers',
+        'current-tubes',
+        'current-jobs-ready',
+        'current-jobs-urgent',
+        'current-jobs-buried',
+        'current-jobs-reserved',
+        'put-rate',
+        'delete-rate',
+        'bury-rate',
+        ))
+
+DEFAULT_ROW = dict(
+    (i, '-') for i in (
+        'current-jobs-buried',
+        'current-jobs-delayed',
+        'current-jobs-ready',
+        'current-jobs-reserved',
+        'current-jobs-urgent',
+        'put-rate',
+        'delete-rate',
+        'bury-rate',
+        'eta',
+        ))
+
+DEFAULT_ROW.update({'name': 'default'})
+
+# Per-tube metrics kept in the sample history.
+HISTORY_METRICS = (
+    'current-jobs-ready',
+    'current-jobs-reserved',
+    'current-jobs-buried',
+    'put-rate',
+    'delete-rate',
+    )
+
+SPARKLINE_CHARS = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+SPARKLINE_CHARS_ASCII = '_.-:=+*#'
+
+# A snapshot older than this many refresh intervals is shown as stale.
+STALE_AFTER_INTERVALS = 2
+
+# --record files start with RECORD_MAGIC, then one RECORD_FRAME header
+# (payload length, kind, unix time) per tick followed by its payload;
+# FILE.idx holds a RECORD_INDEX_ENTRY (unix time, offset) per key frame.
+RECORD_MAGIC = b'BSTOPREC\x01'
+RECORD_FRAME = struct.Struct('<IBd')
+RECORD_INDEX_ENTRY = struct.Struct('<dQ')
+RECORD_KEY = 0
+RECORD_DELTA = 1
+RECORD_KEY_INTERVAL = 60
+
+# Timed phases and per-tick counts shown by the 'i' overlay, with the
+# unit each is recorded in, and how many recent samples it summarises.
+INSTRUMENTS = (
+    ('connect', 'us'),
+    ('round-trip', 'us'),
+    ('parse', 'us'),
+    ('render', 'us'),
+    ('first-frame', 'us'),
+    ('first-live-frame', 'us'),
+    ('bytes', 'B'),
+    ('commands', ''),
+    )
+INSTRUMENT_WINDOW = 200
+
+# --canary probes through a tube named with this prefix, and tubes with
+# it are never shown, whichever beanstalktop created them.
+CANARY_TUBE_PREFIX = '__beanstalktop_probe'
+
+# LogHistogram buckets per doubling, and how many doublings (of
+# microseconds) it covers.
+LOG_HISTOGRAM_STEPS = 4
+LOG_HISTOGRAM_DOUBLINGS = 40
+
+# With --tube-budget, tubes whose stats changed this recently are
+# polled ahead of the rotation.
+RECENT_CHANGE_SECONDS = 30.0
+
+# Per-request tubes come and go, so forget filter verdicts before the
+# cache of them outgrows any plausible listing.
+TUBE_FILTER_CACHE_SIZE = 100000
+
+# The job drill-down: the least time between looks at a tube, how many
+# stats-job replies are cached and for how long, and how much of each
+# job body is kept to show.
+DRILL_DOWN_INTERVAL = 2.0
+JOB_CACHE_SIZE = 256
+JOB_STATS_MAX_AGE = 10.0
+JOB_PREVIEW_BYTES = 200
+
+# Kicks and drains started from the display: how many jobs they move a
+# second unless --action-rate says otherwise, how far apart their
+# batches go, and how long the outcome stays in the header afterwards.
+ACTION_RATE = 500.0
+ACTION_BATCH_INTERVAL = 0.25
+ACTION_RESULT_SECONDS = 10.0
+
+# How often the interactive display saves each host's latest collection
+# for the next start to draw its first frame from.
+SNAPSHOT_CACHE_INTERVAL = 60.0
+
+REPLAY_SEEK_STEP = 10.0
+REPLAY_MAX_SPEED = 64.0
+REPLAY_MAX_WAIT = 5.0
+
+# The YAML 1.1 spellings PyYAML resolves to booleans and null.
+YAML_CONSTANTS = dict(
+    [(spelling, True) for word in ('true', 'yes', 'on')
+     for spelling in (word, word.capitalize(), word.upper())] +
+    [(spelling, False) for word in ('false', 'no', 'off')
+     for spelling in (word, word.capitalize(), word.upper())] +
+    [(spelling, None) for spelling in ('~', 'null', 'Null', 'NULL', '')])
+
+# PyYAML's YAML 1.1 patterns for plain integers and floats.
+YAML_INT = re.compile(r'''^(?:[-+]?0b[0-1_]+
+                    |[-+]?0[0-7_]+
+                    |[-+]?(?:0|[1-9][0-9_]*)
+                    |[-+]?0x[0-9a-fA-F_]+
+                    |[-+]?[1-9][0-9_]*(?::[0-5]?[0-9])+)$''', re.X)
+YAML_FLOAT = re.compile(r'''^(?:[-+]?(?:[0-9][0-9_]*)\.[0-9_]*(?:[eE][-+][0-9]+)?
+                    |\.[0-9][0-9_]*(?:[eE][-+][0-9]+)?
+                    |[-+]?[0-9][0-9_]*(?::[0-5]?[0-9])+\.[0-9_]*
+                    |[-+]?\.(?:inf|Inf|INF)
+                    |\.(?:nan|NaN|NAN))$''', re.X)
+YAML_NUMBER_START = frozenset('-+0123456789.')
+
+
+def parse_yaml_sexagesimal(digits, number):
+    value = 0
+    for part in digits.split(':'):
+        value = value * 60 + number(part)
+    return value
+
+
+def parse_yaml_int(value):
+    value = value.replace('_', '')
+    sign = -1 if value[0] == '-' else 1
+    value = value.lstrip('+-')
+    if value == '0':
+        return 0
+    if value.startswith('0b'):
+        return sign * int(value[2:], 2)
+    if value.startswith('0x'):
+        return sign * int(value[2:], 16)
+    if value[0] == '0':
+        return sign * int(value, 8)
+    if ':' in value:
+        return sign * parse_yaml_sexagesimal(value, int)
+    return sign * int(value)
+
+
+def parse_yaml_float(value):
+    value = value.replace('_', '').lower()
+    sign = -1 if value[0] == '-' else 1
+    value = value.lstrip('+-')
+    if value == '.inf':
+        return sign * INFINITY
+    if value == '.nan':
+        return NAN
+    if ':' in value:
+        return sign * parse_yaml_sexagesimal(value, float)
+    return sign * float(value)
+
+
+def parse_yaml_scalar(value):
+    """
+    A plain or quoted scalar as yaml.safe_load would read it, short of
+    timestamps, which beanstalkd never sends.
+    """
+    # Nearly every value is a plain decimal count.
+    if value.isdigit() and value.isascii() and (value[0] != '0' or value == '0'):
+        return int(value)
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    if '#' in value:
+        # A # after a space starts a comment, such as the kernel version
+        # in `os: #1 SMP ...`.
+        value = ('' if value[0] == '#' else value).partition(' #')[0].rstrip()
+    if value[:1] in YAML_NUMBER_START:
+        if YAML_INT.match(value):
+            return parse_yaml_int(value)
+        if YAML_FLOAT.match(value):
+            return parse_yaml_float(value)
+    return YAML_CONSTANTS.get(value, value)
+
+
+def parse_yaml(body):
+    """
+    Parse the two YAML shapes beanstalkd ever replies with -- a flat
+    `key: value` mapping (stats, stats-tube, stats-job) or a `- item`
+    list (list-tubes) -- without going through PyYAML. Tube names,
+    the list items and a mapping's `name`, stay strings however they
+    look: a tube called 007 or yes is still that tube.
+    """
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+
+    lines = body.splitlines()
+    if lines and lines[0].startswith('---'):
+        lines = lines[1:]
+    lines = [line for line in lines if line.strip()]
+
+    if lines and lines[0].startswith('- '):
+        return [parse_yaml_name(line[2:].strip()) for line in lines]
+
+    result = {}
+    for line in lines:
+        key, _, value = line.partition(':')
+        # Every reply repeats the same few keys; share one copy of each.
+        key, value = sys.intern(key.strip()), value.strip()
+        result[key] = parse_yaml_name(value) if key == 'name' else parse_yaml_scalar(value)
+    return result
+
+
+def parse_yaml_name(value):
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+def counter_rate(value, previous, elapsed):
+    """
+    Per-second rate of a monotonically increasing counter; a counter
+    that went backwards has been reset, so it counts up from zero.
+    """
+    if not isinstance(value, (int, float)) or elapsed <= 0:
+        return '-'
+    if value < previous:
+        previous = 0
+    return round((value - previous) / elapsed, 1)
+
+
+def drain_eta(ready, arrival, completion):
+    """
+    Seconds until `ready` jobs are gone at the given per-second arrival
+    and completion rates, GROWING if they never will be, or '-' when
+    neither rate says anything.
+    """
+    if not isinstance(ready, int):
+        return '-'
+    if completion > arrival:
+        return int(math.ceil(ready / (completion - arrival)))
+    if arrival > completion:
+        return GROWING
+    return 0 if ready == 0 else '-'
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return '{0}s'.format(seconds)
+    if seconds < 3600:
+        return '{0}m{1:02}s'.format(*divmod(seconds, 60))
+    if seconds < 86400:
+        return '{0}h{1:02}m'.format(seconds // 3600, seconds % 3600 // 60)
+    return '{0}d{1:02}h'.format(seconds // 86400, seconds % 86400 // 3600)
+
+
+def format_uptime(seconds):
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return '{0}h {1}m {2}s'.format(hours, minutes, seconds)
+
+
+def format_summary(overview, items=SUMMARY_ITEMS):
+    overview = dict(overview)
+    try:
+        overview['uptime'] = format_uptime(overview.get('uptime', 0))
+    except (TypeError, ValueError):
+        overview['uptime'] = format_uptime(0)
+    return [item.format(**overview) for item in items]
+
+
+def parse_pyyaml(body):
+    import yaml
+    result = yaml.safe_load(body)
+    # As with parse_yaml, tube names stay strings; the base loader
+    # resolves nothing.
+    if isinstance(result, list) or (isinstance(result, dict) and
+                                    not isinstance(result.get('name', ''), str)):
+        names = yaml.load(body, Loader=yaml.BaseLoader)
+        if isinstance(result, list):
+            return names
+        result['name'] = names['name']
+    return result
+
+
+def format_instrument_value(value, unit):
+    if unit == 'us':
+        if value >= 1000000:
+            return '{0:.2f}s'.format(value / 1000000.0)
+        return '{0:.2f}ms'.format(value / 1000.0)
+    if unit == 'B':
+        for suffix in ('B', 'K', 'M'):
+            if value < 1024:
+                return '{0:.0f}{1}'.format(value, suffix) if suffix == 'B' else \
+                    '{0:.1f}{1}'.format(value, suffix)
+            value /= 1024.0
+        return '{0:.1f}G'.format(value)
+    return str(value)
+
+
+def wake(fd):
+    """
+    Nudge the display's select() loop through the pipe at `fd`, if
+    there is one; a full pipe is already waking it.
+    """
+    if fd is not None:
+        try:
+            os.write(fd, b'.')
+        except OSError:
+            pass
+
+
+def close_quietly(connection):
+    """
+    Close a beanstalkc connection that may already be broken, since
+    there's nothing to be done about one that won't close.
+    """
+    if connection is not None:
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+
+class Instruments(object):
+    """
+    Timings of each phase of a refresh (in microseconds) and per-tick
+    byte and command counts, kept two ways: the last `window` samples
+    of each for the overlay's percentiles, and a power-of-two
+    histogram over the whole run for --profile. Host threads and the
+    render loop all record here, so updates take a lock.
+    """
+
+    def __init__(self, window=INSTRUMENT_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = dict((name, collections.deque(maxlen=window)) for name, _ in INSTRUMENTS)
+        self._histograms = dict((name, collections.Counter()) for name, _ in INSTRUMENTS)
+        self._tick = collections.Counter()
+
+
+    def record(self, name, value):
+        with self._lock:
+            self._samples[name].append(value)
+            self._histograms[name][int(value).bit_length()] += 1
+
+
+    def record_time(self, name, seconds):
+        self.record(name, int(seconds * 1000000))
+
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._tick[name] += amount
+
+
+    def end_tick(self):
+        with self._lock:
+            tick, self._tick = self._tick, collections.Counter()
+        self.record('bytes', tick['bytes'])
+        self.record('commands', tick['commands'])
+
+
+    def timed_parse(self, parse):
+        """
+        Wrap a reply parser so it records its time and the size of
+        every body it is handed.
+        """
+        def timed(body):
+            started = time.perf_counter()
+            result = parse(body)
+            self.record_time('parse', time.perf_counter() - started)
+            self.count('bytes', len(body))
+            return result
+        return timed
+
+
+    def summary(self, name):
+        """
+        (p50, p99, max, samples) over the recent window.
+        """
+        with self._lock:
+            samples = sorted(self._samples[name])
+        if not samples:
+            return None
+        return (samples[len(samples) // 2],
+                samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+                samples[-1],
+                len(samples))
+
+
+    def format_histograms(self):
+        """
+        Every phase's histogram for the whole run, one line per bucket.
+        """
+        out = []
+        with self._lock:
+            histograms = dict((name, dict(counts)) for name, counts in self._histograms.items())
+        for name, unit in INSTRUMENTS:
+            counts = histograms[name]
+            total = sum(counts.values())
+            out.append('{0} ({1} samples)'.format(name, total))
+            if not total:
+                continue
+            widest = max(counts.values())
+            for bucket in range(min(counts), max(counts) + 1):
+                count = counts.get(bucket, 0)
+                upper = format_instrument_value(2 ** bucket, unit)
+                out.append('  < {0:>9} {1:>8} {2}'.format(
+                    upper, count, '#' * int(round(40.0 * count / widest))))
+        return '\n'.join(out) + '\n'
+
+
+
+class LogHistogram(object):
+    """
+    Counts of values (microseconds) in logarithmic buckets, `steps` to
+    each doubling. Memory is fixed however many values go in, and a
+    percentile is only ever out by a bucket's width (about 19% with
+    four steps). Probes on every host record here, hence the lock.
+    """
+
+    def __init__(self, steps=LOG_HISTOGRAM_STEPS, doublings=LOG_HISTOGRAM_DOUBLINGS):
+        self.steps = steps
+        self.counts = array.array('L', [0] * (steps * doublings + 1))
+        self.total = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+
+    def record(self, value):
+        bucket = 0
+        if value >= 1:
+            bucket = min(len(self.counts) - 1, int(math.log2(value) * self.steps) + 1)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.total += 1
+            self.max = max(self.max, value)
+
+
+    def percentile(self, fraction):
+        """
+        The upper bound of the bucket holding the value `fraction` of
+        the way up, or None when nothing has been recorded.
+        """
+        with self._lock:
+            if not self.total:
+                return None
+            rank = max(1, int(math.ceil(fraction * self.total)))
+            seen = 0
+            for bucket, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return min(self.max, 2 ** (bucket / float(self.steps)))
+
+
+    def format(self):
+        """
+        p50/p99/max in milliseconds.
+        """
+        if not self.total:
+            return '-'
+        return '{0:.2f}/{1:.2f}/{2:.2f}ms'.format(
+            self.percentile(0.5) / 1000.0, self.percentile(0.99) / 1000.0, self.max / 1000.0)
+
+
+
+class LatencyCanary(threading.Thread):
+    """
+    Measures how quickly a server actually hands out work: every
+    `--delay` seconds it puts a timestamped job on a tube of our own,
+    reserves it and deletes it again, on a thread and connection of its
+    own so that a slow reserve never holds up collecting stats. The
+    time from put to reserve and for the whole exchange go into the
+    shared histograms, and the commands it sends are counted for
+    take_counts() so the server-wide rates can leave them out.
+    """
+
+    def __init__(self, host, port, options, reserve_latency, total_latency):
+        super(LatencyCanary, self).__init__(name='beanstalktop-canary')
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.options = options
+        self.reserve_latency = reserve_latency
+        self.total_latency = total_latency
+        # Unique per process, so that two beanstalktops probing the same
+        # server never reserve each other's jobs.
+        self.tube = '{0}.{1}.{2:x}'.format(CANARY_TUBE_PREFIX, os.getpid(), random.getrandbits(32))
+        self.failures = 0
+        self._connection = None
+        self._counts = dict.fromkeys(('cmd-put', 'cmd-delete'), 0)
+        self._counts_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+
+    def run(self):
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            self.probe()
+            self._stopped.wait(self.options.delay_seconds - (time.monotonic() - started))
+        self.close()
+
+
+    def take_counts(self):
+        """
+        The puts and deletes sent since the last call, by the stats
+        counter they show up in.
+        """
+        with self._counts_lock:
+            counts = self._counts
+            self._counts = dict.fromkeys(counts, 0)
+        return counts
+
+
+    def _count(self, counter):
+        with self._counts_lock:
+            self._counts[counter] += 1
+
+
+    def _connect(self):
+        connection = beanstalkc.Connection(
+            host=self.host, port=self.port, parse_yaml=False,
+            connect_timeout=self.options.timeout)
+        # Leave room for a reserve that waits the full timeout.
+        connection._socket.settimeout(self.options.timeout + 1)
+        connection.use(self.tube)
+        connection.watch(self.tube)
+        connection.ignore('default')
+        return connection
+
+
+    def probe(self):
+        try:
+            if self._connection is None:
+                self._connection = self._connect()
+            connection = self._connection
+
+            started = time.perf_counter()
+            jid = connection.put(repr(time.time()))
+            self._count('cmd-put')
+            timeout = int(math.ceil(self.options.timeout))
+            job = connection.reserve(timeout=timeout)
+            # A probe that died between reserve and delete leaves its
+            # job behind to come back once its TTR runs out.
+            while job is not None and job.jid != jid:
+                job.delete()
+                self._count('cmd-delete')
+                job = connection.reserve(timeout=timeout)
+            reserved = time.perf_counter()
+            if job is None:
+                raise beanstalkc.CommandFailed('reserve', 'TIMED_OUT', [])
+            job.delete()
+            self._count('cmd-delete')
+            finished = time.perf_counter()
+        except (beanstalkc.SocketError, beanstalkc.CommandFailed, beanstalkc.DeadlineSoon,
+                beanstalkc.UnexpectedResponse):
+            self.failures += 1
+            self.close()
+            return
+
+        self.reserve_latency.record((reserved - started) * 1000000)
+        self.total_latency.record((finished - started) * 1000000)
+
+
+    def close(self):
+        close_quietly(self._connection)
+        self._connection = None
+
+
+    def stop(self, timeout=0.5):
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+        if not self.is_alive():
+            self.close()
+
+
+
+class JobStatsCache(object):
+    """
+    stats-job replies by job id, the least recently used dropped once
+    there are more than `size`. A reply is used for up to `max_age`
+    seconds, with its age and time-left moved on by the time since it
+    was taken.
+    """
+
+    def __init__(self, size=JOB_CACHE_SIZE, max_age=JOB_STATS_MAX_AGE):
+        self.size = size
+        self.max_age = max_age
+        self._entries = collections.OrderedDict()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def get(self, jid, now):
+        entry = self._entries.get(jid)
+        if entry is None:
+            return None
+        taken, stats = entry
+        if now - taken > self.max_age:
+            del self._entries[jid]
+            return None
+        self._entries.move_to_end(jid)
+        elapsed = int(now - taken)
+        stats = dict(stats)
+        if isinstance(stats.get('age'), int):
+            stats['age'] += elapsed
+        if isinstance(stats.get('time-left'), int):
+            stats['time-left'] = max(0, stats['time-left'] - elapsed)
+        return stats
+
+
+    def put(self, jid, stats, now):
+        self._entries[jid] = (now, stats)
+        self._entries.move_to_end(jid)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+
+def job_preview(body):
+    """
+    At most JOB_PREVIEW_BYTES of a job body as printable text.
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    text = body[:JOB_PREVIEW_BYTES].decode('utf-8', 'replace')
+    return ''.join(c if c.isprintable() else '.' for c in text)
+
+
+
+class JobInspector(threading.Thread):
+    """
+    Peeks at the next ready, delayed and buried job of the tube being
+    drilled into, over a connection of its own, and publishes them as
+    `jobs`: (state, job id, stats-job, body preview) for each state
+    with a job. Looks are at least DRILL_DOWN_INTERVAL apart however
+    often a tube is opened, and stats come from the JobStatsCache
+    where they can, so even a busy tube sees only a few commands every
+    couple of seconds.
+    """
+
+    def __init__(self, options, cache, wakeup_fd=None):
+        super(JobInspector, self).__init__(name='beanstalktop-inspector')
+        self.daemon = True
+        self.options = options
+        self.cache = cache
+        self.wakeup_fd = wakeup_fd
+        self.target = None
+        self.jobs = None
+        self.error = None
+        self._connection = None
+        self._connected_to = None
+        self._last_look = -DRILL_DOWN_INTERVAL
+        self._wake = threading.Event()
+        self._stopped = False
+
+
+    def inspect(self, host, port, tube):
+        self.target = (host, port, tube)
+        self.jobs = self.error = None
+        self._wake.set()
+
+
+    def stop_inspecting(self):
+        self.target = None
+        self.jobs = self.error = None
+        self._wake.set()
+
+
+    def run(self):
+        while not self._stopped:
+            target = self.target
+            wait = self._last_look + DRILL_DOWN_INTERVAL - time.monotonic()
+            if target is None or wait > 0:
+                if target is None:
+                    self._close_connection()
+                self._wake.wait(None if target is None else wait)
+                self._wake.clear()
+                continue
+
+            self._last_look = time.monotonic()
+            try:
+                jobs, error = self._look(*target), None
+            except (beanstalkc.SocketError, beanstalkc.CommandFailed, beanstalkc.UnexpectedResponse) as e:
+                jobs, error = None, 'error: {0}'.format(e.__class__.__name__)
+                self._close_connection()
+            except Exception as e:
+                # Anything else is shown on the request rather than left
+                # to end the thread and every drill-down after it.
+                jobs, error = None, 'error: {0}: {1}'.format(e.__class__.__name__, e)
+                self._close_connection()
+            if target == self.target:
+                self.jobs, self.error = jobs, error
+                wake(self.wakeup_fd)
+
+
+    def _look(self, host, port, tube):
+        if self._connected_to != (host, port):
+            self._close_connection()
+            self._connection = beanstalkc.Connection(
+                host=host, port=port, parse_yaml=parse_yaml,
+                connect_timeout=self.options.timeout)
+            self._connection._socket.settimeout(self.options.timeout)
+            self._connected_to = (host, port)
+        connection = self._connection
+        connection.use(tube)
+
+        jobs = []
+        now = time.monotonic()
+        for state in ('ready', 'delayed', 'buried'):
+            try:
+                job = getattr(connection, 'peek_' + state)()
+            except UnicodeDecodeError:
+                # The body was read but isn't text; the job id went with it.
+                jobs.append((state, None, {}, '(body is not utf-8)'))
+                continue
+            if job is None:
+                continue
+            stats = self.cache.get(job.jid, now)
+            if stats is None:
+                try:
+                    stats = connection.stats_job(job.jid)
+                except beanstalkc.CommandFailed:
+                    # Deleted between the peek and now.
+                    stats = {}
+                self.cache.put(job.jid, stats, now)
+            jobs.append((state, job.jid, stats, job_preview(job.body)))
+        return jobs
+
+
+    def _close_connection(self):
+        close_quietly(self._connection)
+        self._connection = self._connected_to = None
+
+
+    def stop(self, timeout=0.5):
+        self._stopped = True
+        self._wake.set()
+        if self.is_alive():
+            self.join(timeout)
+        if not self.is_alive():
+            self._close_connection()
+
+
+
+class TubeAction(threading.Thread):
+    """
+    A kick, pause or drain of one tube, run over a connection of its own
+    so that the display keeps refreshing. `count` is the jobs to kick or
+    delete, None for all that are buried, or the seconds to pause for.
+
+    Kicks and drains go in batches ACTION_BATCH_INTERVAL apart that
+    together move at most `rate` jobs a second. Each batch starts by
+    reading the tube's current-jobs-buried, so `buried` and `total`
+    follow the server, jobs buried meanwhile included, rather than what
+    has been sent. `cancel()` stops it before the next batch.
+    """
+
+    def __init__(self, options, kind, host, port, tube, count, wakeup_fd=None):
+        super(TubeAction, self).__init__(name='beanstalktop-action')
+        self.daemon = True
+        self.options = options
+        self.kind = kind
+        self.host = host
+        self.port = port
+        self.tube = tube
+        self.count = count
+        self.rate = options.action_rate
+        self.wakeup_fd = wakeup_fd
+        self.done = 0
+        self.total = None
+        self.buried = None
+        self.error = None
+        self.finished_at = None
+        self._cancelled = threading.Event()
+
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+
+    def cancel(self):
+        self._cancelled.set()
+
+
+    def run(self):
+        connection = None
+        try:
+            # Bodies are never looked at, so leave them as bytes; a drain
+            # mustn't stall on one that isn't text.
+            connection = beanstalkc.Connection(
+                host=self.host, port=self.port, parse_yaml=parse_yaml,
+                connect_timeout=self.options.timeout, encoding=None)
+            connection._socket.settimeout(self.options.timeout)
+            if self.kind == 'pause':
+                connection.pause_tube(self.tube, self.count)
+                self.done = self.total = 1
+            else:
+                connection.use(self.tube)
+                self._run_batches(connection, self._kick_batch if self.kind == 'kick' else self._delete_batch)
+        except (beanstalkc.SocketError, beanstalkc.CommandFailed, beanstalkc.UnexpectedResponse) as e:
+            self.error = 'error: {0}'.format(e.__class__.__name__)
+        finally:
+            close_quietly(connection)
+            self.finished_at = time.monotonic()
+            wake(self.wakeup_fd)
+
+
+    def _run_batches(self, connection, step):
+        batch_size = max(1, int(self.rate * ACTION_BATCH_INTERVAL))
+        next_batch = time.monotonic()
+        while True:
+            self.buried = connection.stats_tube(self.tube)['current-jobs-buried']
+            remaining = self.buried
+            if self.count is not None:
+                remaining = min(remaining, self.count - self.done)
+            self.total = self.done + remaining
+            wake(self.wakeup_fd)
+            if remaining <= 0 or self._cancelled.wait(next_batch - time.monotonic()):
+                return
+            started = time.monotonic()
+            moved = step(connection, min(remaining, batch_size))
+            self.done += moved
+            # A batch another client emptied first still counts against the
+            # rate, so a tube being fought over isn't polled flat out.
+            next_batch = started + max(1, moved) / self.rate
+
+
+    def _kick_batch(self, connection, bound):
+        # kick takes delayed jobs when none are buried; keeping the bound
+        # to the buried count just read leaves them alone.
+        return connection.kick(bound)
+
+
+    def _delete_batch(self, connection, bound):
+        deleted = 0
+        for _ in range(bound):
+            job = connection.peek_buried()
+            if job is None:
+                break
+            try:
+                connection.delete(job.jid)
+            except beanstalkc.CommandFailed:
+                # Deleted or kicked by another client since the peek.
+                continue
+            deleted += 1
+        return deleted
+
+
+    def stop(self, timeout=0.5):
+        self.cancel()
+        if self.is_alive():
+            self.join(timeout)
+
+
+
+class TubeFilter(object):
+    """
+    Decides which tubes are worth a stats-tube. Patterns are globs, or
+    regular expressions when written re:REGEX; a tube is kept if it
+    matches an include pattern (or there are none) and no exclude
+    pattern. Each side is compiled once into a single regex and the
+    verdict for every tube name is cached.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self._include = self._compile(self.include)
+        self._exclude = self._compile(self.exclude)
+        self._cache = {}
+
+
+    @classmethod
+    def parse(cls, text):
+        """
+        A filter from space separated patterns, excludes marked with a
+        leading '!', as typed at the interactive prompt.
+        """
+        include, exclude = [], []
+        for term in text.split():
+            if term.startswith('!'):
+                exclude.append(term[1:])
+            else:
+                include.append(term)
+        return cls(include, exclude)
+
+
+    def __str__(self):
+        return ' '.join(self.include + tuple('!' + pattern for pattern in self.exclude))
+
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+
+
+    def _compile(self, patterns):
+        if not patterns:
+            return None
+        # Globs must match the whole name, regexes anywhere in it.
+        return re.compile('|'.join(
+            '(?:.*?(?:{0}))'.format(pattern[3:]) if pattern.startswith('re:')
+            else '(?:{0})'.format(fnmatch.translate(pattern))
+            for pattern in patterns))
+
+
+    def matches(self, name):
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        # Names read by an older parser, or from a recording made with
+        # one, can be numbers.
+        text = str(name)
+        keep = ((self._include is None or self._include.match(text) is not None) and
+                (self._exclude is None or self._exclude.match(text) is None))
+        if len(self._cache) >= TUBE_FILTER_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[name] = keep
+        return keep
+
+
+    def select(self, names):
+        if not self:
+            return names
+        return [name for name in names if self.matches(name)]
+
+
+
+def filter_lines(tube_filter, lines):
+    """
+    The rows of a finished table that pass `tube_filter`, for sources
+    that can't filter before collecting. Host rows are always kept, and
+    with several hosts a tube is matched without its host:port/ prefix.
+    """
+    if not tube_filter:
+        return lines
+    hosts = set(line['name'] for line in lines if line.get('host-row'))
+    kept = []
+    for line in lines:
+        if line.get('host-row'):
+            kept.append(line)
+            continue
+        name = line['name']
+        if hosts:
+            host, _, tube = str(name).partition('/')
+            if host in hosts:
+                name = tube
+        if tube_filter.matches(name):
+            kept.append(line)
+    return kept
+
+
+
+class TubeCounters(object):
+    """
+    The per-tube counters a host's rates are taken from, kept from one
+    collection to the next a column at a time instead of as the last
+    collection's rows: an array('d') per counter, indexed by the host's
+    own TubeIds, with NaN for a value the tube didn't have. Each tube is
+    stamped with the record() that last wrote it, and the monotonic time
+    it did so, and only stamps from `valid_from` on count as having a
+    previous value.
+    """
+
+    fields = tuple(tube_counter for _, _, tube_counter in RATE_COUNTERS
+                   if tube_counter is not None)
+
+    def __init__(self):
+        self.tube_ids = TubeIds()
+        self.columns = dict((field, array.array('d')) for field in self.fields)
+        self.polled_at = array.array('d')
+        self.stamps = array.array('l')
+        self.stamp = 0
+        self.valid_from = 1
+
+
+    def ids(self, names):
+        ids = self.tube_ids.intern_all(names)
+        grow = len(self.tube_ids) - len(self.stamps)
+        if grow > 0:
+            for column in self.columns.values():
+                column.frombytes(NAN_BYTES * grow)
+            self.polled_at.frombytes(NAN_BYTES * grow)
+            self.stamps.frombytes(bytes(self.stamps.itemsize * grow))
+        return ids
+
+
+    def has(self, tube_id):
+        return self.stamps[tube_id] >= self.valid_from
+
+
+    def forget(self, name):
+        tube_id = self.tube_ids.lookup(name)
+        if tube_id is not None:
+            self.stamps[tube_id] = 0
+
+
+    def forget_all(self):
+        self.valid_from = self.stamp + 1
+
+
+    def record(self, lines, ids, now, partial, listed):
+        """
+        Write this collection's counters, taken at monotonic time `now`. Without a tube budget only the
+        tubes just written count as previous next time; with one, every
+        tube does until forget() says it has gone. Ids are reissued once
+        tubes that have gone outnumber the `listed` ones two to one.
+        """
+        self.stamp += 1
+        stamp, stamps = self.stamp, self.stamps
+        for field, column in self.columns.items():
+            for line, tube_id in zip(lines, ids):
+                value = line.get(field)
+                column[tube_id] = value if isinstance(value, (int, float)) else NAN
+        polled_at = self.polled_at
+        for tube_id in ids:
+            stamps[tube_id] = stamp
+            polled_at[tube_id] = now
+        if not partial:
+            self.valid_from = stamp
+        if len(self.tube_ids) > max(TUBE_IDS_MIN, 2 * listed):
+            return self._compacted()
+        return self
+
+
+    def _compacted(self):
+        counters = TubeCounters()
+        kept = [(name, tube_id) for name, tube_id in self.tube_ids._ids.items() if self.has(tube_id)]
+        new_ids = counters.ids([name for name, _ in kept])
+        for field, column in self.columns.items():
+            new_column = counters.columns[field]
+            for (_, tube_id), new_id in zip(kept, new_ids):
+                new_column[new_id] = column[tube_id]
+        for (_, tube_id), new_id in zip(kept, new_ids):
+            counters.polled_at[new_id] = self.polled_at[tube_id]
+            counters.stamps[new_id] = 1
+        counters.stamp = counters.valid_from = 1
+        return counters
+
+
+
+def reconnect_deadline(attempts):
+    """
+    The time.monotonic() before which the next reconnect, after
+    `attempts` failed ones, should not be tried.
+    """
+    delay = min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_MIN * (2 ** attempts))
+    return time.monotonic() + delay
+
+
+
+class BeanstalkHost(object):
+    """
+    A single beanstalkd server, holding one long-lived connection that
+    is health checked before use and re-established with exponential
+    backoff when it goes away.
+    """
+
+    def __init__(self, host, port, options, canary=None):
+        self.host = host
+        self.port = int(port)
+        self.options = options
+        self.canary = canary
+
+        self._connection = None
+        self._reconnect_attempts = 0
+        self._reconnect_at = 0
+        self.connection_state = 'disconnected'
+        self._previous = None
+        self._counters = TubeCounters()
+        self._forecasts = {}
+        self.tube_filter = options.tube_filter
+        self.instruments = options.instruments
+        self._filter_changed = False
+        self.visible_tubes = []
+        self._known_tubes = {}
+        self._changed_at = {}
+        self._rotation = 0
+        self.error = None
+
+
+    @property
+    def label(self):
+        return '{0}:{1}'.format(self.host, self.port)
+
+
+    def _get_connection(self):
+        if self._connection is not None and not self._connection_healthy(self._connection):
+            self._drop_connection()
+
+        if self._connection is None:
+            if time.monotonic() < self._reconnect_at:
+                raise beanstalkc.SocketError('waiting to reconnect')
+            started = time.perf_counter()
+            try:
+                self._connection = beanstalkc.Connection(
+                    host=self.host, port=self.port,
+                    parse_yaml=self.instruments.timed_parse(
+                        parse_pyyaml if self.options.pyyaml else parse_yaml),
+                    connect_timeout=self.options.timeout)
+            except beanstalkc.SocketError:
+                self._schedule_reconnect()
+                raise
+            self.instruments.record_time('connect', time.perf_counter() - started)
+            # beanstalkc clears the timeout once connected; put it back
+            # so a hung server fails the request instead of the collector.
+            self._connection._socket.settimeout(self.options.timeout)
+            self.connection_state = 'connected'
+            self._reconnect_attempts = 0
+            self._reconnect_at = 0
+        return self._connection
+
+    connection = property(_get_connection)
+
+
+    def _connection_healthy(self, connection):
+        """
+        An idle connection should have nothing to read; if the socket
+        is readable the server has either closed it or sent something
+        we never asked for, and neither can be trusted.
+        """
+        try:
+            readable, _, _ = select.select([connection._socket], [], [], 0)
+        except (select.error, ValueError):
+            return False
+        return not readable
+
+
+    def _drop_connection(self):
+        close_quietly(self._connection)
+        self._connection = None
+        self._schedule_reconnect()
+
+
+    def _schedule_reconnect(self):
+        if self.connection_state == 'connected':
+            self._reconnect_attempts = 0
+        self._reconnect_at = reconnect_deadline(self._reconnect_attempts)
+        self._reconnect_attempts += 1
+        if self.connection_state != 'disconnected':
+            self.connection_state = 'reconnecting'
+
+
+    def set_tube_filter(self, tube_filter):
+        self.tube_filter = tube_filter
+        self._filter_changed = True
+
+
+    def format_status(self):
+        if self.error is not None:
+            return self.error
+        if self.connection_state == 'connected':
+            return 'connected'
+        retry = max(0, self._reconnect_at - time.monotonic())
+        return '{0} (retry {1} in {2:.0f}s)'.format(
+            self.connection_state, self._reconnect_attempts, retry)
+
+
+    def get_data(self):
+        """
+        Server and per-tube statistics, or (None, []) if the server
+        could not be queried this time round.
+        """
+        tube_filter, filter_changed = self.tube_filter, self._filter_changed
+        self._filter_changed = False
+        try:
+            connection = self.connection
+            pipeline = self.options.pipeline and self._can_pipeline(connection)
+            if pipeline:
+                overview, tubes = self._interact_pipelined(
+                    connection, ['stats\r\n', 'list-tubes\r\n'])
+                if overview is None or tubes is None:
+                    raise beanstalkc.CommandFailed('stats')
+            else:
+                overview = self._round_trip(connection.stats)
+                tubes = self._round_trip(connection.tubes)
+            tubes = tube_filter.select(
+                [tube for tube in tubes if not tube.startswith(CANARY_TUBE_PREFIX)])
+
+            polled = self._choose_tubes(tubes) if self.options.tube_budget else tubes
+            if pipeline:
+                lines = []
+                for i in range(0, len(polled), PIPELINE_BATCH_SIZE):
+                    lines.extend(self._interact_pipelined(
+                        connection,
+                        ['stats-tube {0}\r\n'.format(tube)
+                         for tube in polled[i:i + PIPELINE_BATCH_SIZE]]))
+            else:
+                lines = [self._round_trip(self._stats_tube, connection, tube) for tube in polled]
+            lines = [line for line in lines if line is not None]
+
+            if self.options.tube_budget:
+                lines = self._merge_polled(overview, tubes, lines, time.monotonic(), filter_changed)
+            else:
+                self._add_rates(overview, lines, time.monotonic(), filter_changed)
+            self.error = None
+            return overview, lines
+        except beanstalkc.SocketError:
+            if self._connection is not None:
+                self._drop_connection()
+            return None, []
+        except (TypeError, beanstalkc.CommandFailed, beanstalkc.UnexpectedResponse):
+            return None, []
+        except Exception as e:
+            # Whatever went wrong, don't take the other hosts' tick down
+            # with this one, but say what it was. A reply may have been
+            # left half read, so start again on a new connection.
+            self.error = 'collection failed: {0}: {1}'.format(e.__class__.__name__, e)
+            self._drop_connection()
+            return None, []
+
+
+    def _choose_tubes(self, tubes):
+        """
+        The --tube-budget tubes to poll this tick: visible rows first,
+        then tubes that changed recently, then the rest in turn. A
+        quarter of the budget always goes to the rotation so that every
+        tube gets refreshed eventually.
+        """
+        budget = self.options.tube_budget
+        if len(tubes) <= budget:
+            return tubes
+
+        listed = set(tubes)
+        chosen = {}
+        priority_budget = budget - max(1, budget // 4)
+        for name in self.visible_tubes:
+            if len(chosen) >= priority_budget:
+                break
+            if name in listed:
+                chosen[name] = None
+
+        recent_since = time.monotonic() - RECENT_CHANGE_SECONDS
+        recent = heapq.nlargest(
+            priority_budget, ((changed, name) for name, changed in self._changed_at.items()
+                              if changed >= recent_since))
+        for _, name in recent:
+            if len(chosen) >= priority_budget:
+                break
+            if name in listed:
+                chosen.setdefault(name)
+
+        position = self._rotation
+        while len(chosen) < budget:
+            chosen.setdefault(tubes[position % len(tubes)])
+            position += 1
+        self._rotation = position % len(tubes)
+        return list(chosen)
+
+
+    def _merge_polled(self, overview, tubes, lines, now, filter_changed):
+        """
+        Fold the tubes polled this tick into the last known stats of
+        every listed tube and return the lot. Each row carries the wall
+        time it was polled at as 'refreshed-at', for the display; rates
+        are taken over the monotonic times TubeCounters keeps.
+        """
+        known = self._known_tubes
+        refreshed_at = time.time()
+        for line in lines:
+            previous = known.get(line['name'])
+            if previous is not None and any(previous.get(key) != value for key, value in line.items()):
+                self._changed_at[line['name']] = now
+            line['refreshed-at'] = refreshed_at
+
+        listed = set(tubes)
+        for name in [name for name in known if name not in listed]:
+            del known[name]
+            self._changed_at.pop(name, None)
+            self._forecasts.pop(name, None)
+            self._counters.forget(name)
+
+        self._add_rates(overview, lines, now, filter_changed, tubes)
+        for line in lines:
+            known[line['name']] = line
+        return [known[name] for name in tubes if name in known]
+
+
+    def _add_rates(self, overview, lines, now, filter_changed=False, listed=None):
+        """
+        Fill in the RATE_COUNTERS rates from the difference to the last
+        successful collection, whose counters are kept in TubeCounters
+        columns. A new pid or a lower uptime means the server restarted
+        and every counter began again from zero `uptime` seconds ago.
+        Tubes a changed filter has just let in have no counts to compare
+        with and get no rate this time.
+
+        With a tube budget `lines` holds only the tubes polled this
+        tick and `listed` every tube the server lists; each rate is
+        then taken over the time since that tube was last polled.
+        """
+        partial = listed is not None
+        counters = self._counters
+        ids = counters.ids([line['name'] for line in lines])
+        previous, self._previous = self._previous, (now, overview)
+        # The canary's own jobs aren't anyone's work.
+        own = self.canary.take_counts() if self.canary is not None else {}
+
+        if previous is None:
+            for rate, _, _ in RATE_COUNTERS:
+                overview[rate] = '-'
+                for line in lines:
+                    line[rate] = '-'
+            for line in lines:
+                line['eta'] = '-'
+            self._counters = counters.record(lines, ids, now, partial, len(listed if partial else lines))
+            return
+
+        then, previous_overview = previous
+        elapsed = now - then
+        if (overview.get('pid') != previous_overview.get('pid') or
+                overview.get('uptime', 0) < previous_overview.get('uptime', 0)):
+            elapsed = min(elapsed, overview.get('uptime', 0))
+            previous_overview = {}
+            counters.forget_all()
+            self._forecasts = {}
+
+        # The time each tube's counts were taken over, or None for a tube
+        # with nothing to compare with, which is '-' when it may simply
+        # not have been polled before and otherwise new in the interval,
+        # with all of its counts happening within it.
+        polled_at = counters.polled_at
+        spans = []
+        for line, tube_id in zip(lines, ids):
+            if not counters.has(tube_id):
+                spans.append(None if filter_changed or partial else elapsed)
+            else:
+                spans.append(now - polled_at[tube_id])
+
+        for rate, counter, tube_counter in RATE_COUNTERS:
+            overview[rate] = counter_rate(
+                overview.get(counter), previous_overview.get(counter, 0), elapsed)
+            if own.get(counter) and isinstance(overview[rate], float):
+                overview[rate] = max(0.0, round(overview[rate] - own[counter] / elapsed, 1))
+            if tube_counter is None:
+                for line in lines:
+                    line[rate] = '-'
+                continue
+            column = counters.columns[tube_counter]
+            for line, tube_id, span in zip(lines, ids, spans):
+                if span is None:
+                    line[rate] = '-'
+                    continue
+                previous_value = column[tube_id] if counters.has(tube_id) else 0
+                line[rate] = counter_rate(
+                    line.get(tube_counter),
+                    previous_value if previous_value == previous_value else 0, span)
+
+        self._add_forecasts(lines, spans)
+        self._counters = counters.record(lines, ids, now, partial, len(listed if partial else lines))
+        live = len(listed) if partial else len(lines)
+        if len(self._forecasts) > live:
+            names = set(listed) if partial else set(line['name'] for line in lines)
+            for name in [name for name in self._forecasts if name not in names]:
+                del self._forecasts[name]
+
+
+    def _add_forecasts(self, lines, spans):
+        """
+        Fold this tick's put and delete rates, taken over `spans`, into
+        each tube's smoothed arrival and completion rates, and forecast
+        from them the 'eta' of its ready jobs. Only tubes that are busy,
+        or were lately, keep smoothed rates; an idle tube costs a lookup.
+        """
+        forecasts = self._forecasts
+        for line, span in zip(lines, spans):
+            name = line['name']
+            arrival, completion = line['put-rate'], line['delete-rate']
+            forecast = forecasts.get(name)
+            if forecast is None and not arrival and not completion:
+                line['eta'] = drain_eta(line.get('current-jobs-ready'), 0, 0)
+                continue
+
+            if isinstance(arrival, float) and isinstance(completion, float):
+                if forecast is None:
+                    forecast = (arrival, completion)
+                else:
+                    weight = 1 - math.exp(-max(0.0, span) / FORECAST_WINDOW)
+                    forecast = (forecast[0] + weight * (arrival - forecast[0]),
+                                forecast[1] + weight * (completion - forecast[1]))
+                if forecast[0] < FORECAST_MIN_RATE and forecast[1] < FORECAST_MIN_RATE:
+                    forecasts.pop(name, None)
+                    forecast = (0, 0)
+                else:
+                    forecasts[name] = forecast
+            elif forecast is None:
+                line['eta'] = '-'
+                continue
+
+            line['eta'] = drain_eta(line.get('current-jobs-ready'), *forecast)
+
+
+    def _can_pipeline(self, connection):
+        return all(hasattr(connection, attr) for attr in (
+            '_socket', '_read_response', '_read_body', '_parse_yaml'))
+
+
+    def _interact_pipelined(self, connection, commands):
+        """
+        Write several yaml-replying commands in one go and read the
+        replies back in order from the connection's buffered reader.
+        Anything other than OK (e.g. NOT_FOUND for a tube deleted since
+        list-tubes) carries no body and comes back as None.
+        """
+        started = time.perf_counter()
+        beanstalkc.SocketError.wrap(
+            connection._socket.sendall, ''.join(commands).encode('ascii'))
+        bodies = []
+        for _ in commands:
+            status, results = connection._read_response()
+            if status == 'OK':
+                bodies.append(connection._read_body(int(results[0])))
+            else:
+                bodies.append(None)
+        self.instruments.record_time('round-trip', time.perf_counter() - started)
+        self.instruments.count('commands', len(commands))
+        return [None if body is None else connection._parse_yaml(body) for body in bodies]
+
+
+    def _round_trip(self, function, *args):
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.instruments.record_time('round-trip', time.perf_counter() - started)
+            self.instruments.count('commands')
+
+
+    def _stats_tube(self, connection, tube):
+        try:
+            return connection.stats_tube(tube)
+        except beanstalkc.CommandFailed:
+            return None
+
+
+
+class ClusterCollector(object):
+    """
+    Polls every host concurrently. beanstalkc is blocking, so each
+    host's collection runs in its own worker thread and asyncio gathers
+    the results; a tick takes as long as the slowest host rather than
+    the sum of all of them.
+    """
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        # Made on the first collection, off the thread drawing the
+        # first frame, as that's what first imports asyncio.
+        self._loop = None
+        self._executor = None
+
+
+    def collect(self):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._executor = futures.ThreadPoolExecutor(max_workers=len(self.hosts))
+        return self._loop.run_until_complete(self._collect())
+
+
+    async def _collect(self):
+        return await asyncio.gather(*[
+            self._loop.run_in_executor(self._executor, host.get_data)
+            for host in self.hosts])
+
+
+    def close(self):
+        if self._loop is not None:
+            self._executor.shutdown(wait=False)
+            self._loop.close()
+
+
+
+class _SeriesRing(object):
+    __slots__ = ('samples', 'count', 'last_seen')
+
+    def __init__(self, length):
+        self.samples = array.array('f', [math.nan]) * length
+        self.count = 0
+        self.last_seen = 0
+
+
+
+class History(object):
+    """
+    The last `size` samples of every HISTORY_METRICS value for each row,
+    held in one float32 ring per row so memory stays fixed no matter how
+    long we run. Rows missing for `expiry` seconds are dropped.
+    """
+
+    def __init__(self, size, expiry, metrics=HISTORY_METRICS):
+        self.size = size
+        self.expiry = expiry
+        self.metrics = metrics
+        self._rings = {}
+        self._last_sweep = 0
+
+
+    def record(self, lines, now):
+        size = self.size
+        for line in lines:
+            ring = self._rings.get(line['name'])
+            if ring is None:
+                ring = self._rings[line['name']] = _SeriesRing(size * len(self.metrics))
+            position = ring.count % size
+            for m, metric in enumerate(self.metrics):
+                value = line.get(metric)
+                ring.samples[m * size + position] = (
+                    value if isinstance(value, (int, float)) else math.nan)
+            ring.count += 1
+            ring.last_seen = now
+
+        if now - self._last_sweep >= min(self.expiry, 10):
+            self._last_sweep = now
+            expired = [name for name, ring in self._rings.items()
+                       if now - ring.last_seen > self.expiry]
+            for name in expired:
+                del self._rings[name]
+
+
+    def clear(self):
+        self._rings.clear()
+
+
+    def series(self, name, metric, count=None):
+        """
+        Up to `count` of the most recent samples, oldest first.
+        """
+        ring = self._rings.get(name)
+        if ring is None:
+            return []
+        size = self.size
+        available = min(ring.count, size, count or size)
+        offset = self.metrics.index(metric) * size
+        return [ring.samples[offset + (ring.count - available + i) % size]
+                for i in range(available)]
+
+
+    def sparkline(self, name, metric, width, chars=SPARKLINE_CHARS):
+        values = self.series(name, metric, width)
+        top = max([v for v in values if not math.isnan(v)] or [0])
+        steps = len(chars) - 1
+        return ''.join(
+            ' ' if math.isnan(v) else chars[int(round(v / top * steps)) if top > 0 else 0]
+            for v in values)
+
+
+
+class TubeIds(object):
+    """
+    Interns tube names as small integer ids that stay the same from one
+    tick to the next, so TubeTable columns can be indexed by tube and
+    compared tick against tick.
+    """
+
+    def __init__(self):
+        self.names = []
+        self._ids = {}
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def intern(self, name):
+        tube_id = self._ids.get(name)
+        if tube_id is None:
+            tube_id = self._ids[name] = len(self.names)
+            self.names.append(name)
+        return tube_id
+
+
+    def lookup(self, name):
+        return self._ids.get(name)
+
+
+    def intern_all(self, names):
+        ids = self._ids
+        return [ids[name] if name in ids else self.intern(name) for name in names]
+
+
+
+class TubeTable(object):
+    """
+    One tick's rows held a column at a time: a float64 array per
+    TABLE_COLUMNS metric, indexed by tube id, with NaN where a row has
+    no value. It holds a few arrays instead of a dict per tube, though
+    it is built from the dicts a collection returns, and it is never
+    changed once built.
+    """
+
+    def __init__(self, tube_ids, rows, present, host_rows, columns):
+        self.tube_ids = tube_ids
+        self.names = tube_ids.names
+        self.rows = rows
+        self.present = present
+        self.host_rows = host_rows
+        self.columns = columns
+
+
+    @classmethod
+    def from_lines(cls, lines, tube_ids):
+        # Every tube name ever seen keeps its id, so start afresh once
+        # the tubes that have come and gone outnumber those still here.
+        if len(tube_ids) > max(TUBE_IDS_MIN, 2 * len(lines)):
+            tube_ids = TubeIds()
+
+        rows = array.array('l', tube_ids.intern_all([line['name'] for line in lines]))
+        size = len(tube_ids)
+        present = bytearray(size)
+        for tube_id in rows:
+            present[tube_id] = 1
+        host_rows = bytearray(size)
+        for tube_id, line in zip(rows, lines):
+            if 'host-row' in line:
+                host_rows[tube_id] = 1
+
+        # A listing in the order its names were first interned (the
+        # usual case) can be copied straight into the columns; otherwise
+        # each id looks up the position of its row, if it has one.
+        positions = None
+        if rows != array.array('l', range(size)):
+            positions = [-1] * size
+            for position, tube_id in enumerate(rows):
+                positions[tube_id] = position
+
+        columns = {}
+        for metric in TABLE_COLUMNS:
+            try:
+                values = [line[metric] for line in lines]
+            except KeyError:
+                values = [line.get(metric, NAN) for line in lines]
+            if positions is not None:
+                values = [values[p] if p >= 0 else NAN for p in positions]
+            try:
+                columns[metric] = array.array('d', values)
+            except TypeError:
+                columns[metric] = array.array('d', [
+                    value if isinstance(value, (int, float)) else
+                    INFINITY if value == GROWING else NAN for value in values])
+
+        return cls(tube_ids, rows, present, host_rows, columns)
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def format_value(self, tube_id, column):
+        if column == 'name':
+            return self.names[tube_id]
+        value = self.columns[column][tube_id]
+        if value != value:
+            return '-'
+        if column == 'eta':
+            return GROWING if value == INFINITY else format_duration(value)
+        if column in FLOAT_COLUMNS:
+            return str(value)
+        return str(int(value))
+
+
+    def changed(self, previous, column):
+        """
+        The ids whose presence or `column` value differs from
+        `previous`, a table sharing the same TubeIds. Runs of unchanged
+        tubes are skipped a block of bytes at a time.
+        """
+        size = len(self.present)
+        old_present = bytes(previous.present) + bytes(size - len(previous.present))
+        new_present = bytes(self.present)
+        if column == 'name':
+            return [tube_id for tube_id in range(size)
+                    if old_present[tube_id] != new_present[tube_id]]
+
+        width = self.columns[column].itemsize
+        old = previous.columns[column].tobytes() + NAN_BYTES * (size - len(previous.present))
+        new = self.columns[column].tobytes()
+        changed = []
+        for start in range(0, size, CHANGE_SCAN_BLOCK):
+            end = min(size, start + CHANGE_SCAN_BLOCK)
+            if (old[start * width:end * width] == new[start * width:end * width] and
+                    old_present[start:end] == new_present[start:end]):
+                continue
+            for tube_id in range(start, end):
+                if (old_present[tube_id] != new_present[tube_id] or
+                        old[tube_id * width:(tube_id + 1) * width] !=
+                        new[tube_id * width:(tube_id + 1) * width]):
+                    changed.append(tube_id)
+        return changed
+
+
+
+class SortedIndex(object):
+    """
+    Tube ids of a TubeTable in display order for one column and
+    direction. Each update only moves the rows whose sort value changed
+    since the previous table, and ties fall back to the row name so
+    equal rows keep their places between refreshes. Host rows always
+    come first; rows without a value last.
+    """
+
+    def __init__(self, column, descending=True):
+        self.column = column
+        self.descending = descending
+        self.tube_ids = TubeIds()
+        self._keys = []
+        self._key_of = {}
+        self._table = None
+
+
+    def _key(self, table, tube_id):
+        name = table.names[tube_id]
+        pinned = 0 if table.host_rows[tube_id] else 1
+        if self.column == 'name':
+            value = name
+            if self.descending:
+                # Negated code points, with a terminator that outranks
+                # them, order strings in reverse.
+                value = tuple(-ord(c) for c in value) + (1,)
+            return (pinned, 0, value, name, tube_id)
+        value = table.columns[self.column][tube_id]
+        if value != value:
+            return (pinned, 1, 0, name, tube_id)
+        return (pinned, 0, -value if self.descending else value, name, tube_id)
+
+
+    def update(self, table):
+        previous = self._table
+        self._table = table
+        if previous is None or table.tube_ids is not self.tube_ids:
+            self.tube_ids = table.tube_ids
+            self._rebuild(table)
+            return
+
+        changed = table.changed(previous, self.column)
+        if len(changed) > len(table) // 4:
+            self._rebuild(table)
+            return
+
+        for tube_id in changed:
+            key = self._key_of.pop(tube_id, None)
+            if key is not None:
+                del self._keys[bisect.bisect_left(self._keys, key)]
+            if table.present[tube_id]:
+                key = self._key_of[tube_id] = self._key(table, tube_id)
+                bisect.insort(self._keys, key)
+
+
+    def _rebuild(self, table):
+        self._key_of = dict((tube_id, self._key(table, tube_id)) for tube_id in table.rows)
+        self._keys = sorted(self._key_of.values())
+
+
+    def head(self, count):
+        """
+        The ids of the first `count` rows in display order.
+        """
+        return [key[-1] for key in self._keys[:count]]
+
+
+
+class AlertRule(object):
+    """
+    One compiled line of a --rules file:
+
+        NAME: [server] FIELD OP VALUE [clear VALUE] [for SECONDS] [cooldown SECONDS]
+
+    FIELD is a tube column, or with `server` an overview field. VALUE
+    is a number, 'growing', or another field; a field the tube rows
+    don't have is read from the overview. Once firing, a rule with
+    `clear` keeps firing until FIELD OP (clear VALUE) stops holding.
+    """
+
+    OPERATORS = {
+        '>': operator.gt,
+        '>=': operator.ge,
+        '<': operator.lt,
+        '<=': operator.le,
+        '==': operator.eq,
+        '!=': operator.ne,
+        }
+
+    def __init__(self, name, field, op, value, clear=None, hold=0.0,
+                 cooldown=ALERT_COOLDOWN, server=False):
+        if op not in self.OPERATORS:
+            raise ValueError('unknown operator {0!r}'.format(op))
+        fields = DEFAULT_OVERVIEW if server else TABLE_COLUMNS
+        if field not in fields:
+            raise ValueError('unknown field {0!r}'.format(field))
+        self.name = name
+        self.field = field
+        self.compare = self.OPERATORS[op]
+        self.server = server
+        self.hold = hold
+        self.cooldown = cooldown
+        self.text = '{0} {1} {2}'.format(field, op, value)
+        # The tube columns and overview fields the rule reads, so the
+        # engine knows when its outcome for a tube could have changed.
+        self.table_inputs = set() if server else set([field])
+        self.overview_inputs = set([field]) if server else set()
+        self.trigger = self._operand(value)
+        self.clear = self.trigger if clear is None else self._operand(clear)
+
+
+    def _operand(self, token):
+        """
+        A function of (overview, table, tube id) giving the value
+        `token` stands for.
+        """
+        if token == GROWING:
+            return lambda overview, table, tube_id: INFINITY
+        try:
+            number = float(token)
+        except ValueError:
+            pass
+        else:
+            return lambda overview, table, tube_id: number
+        if not self.server and token in TABLE_COLUMNS:
+            self.table_inputs.add(token)
+            return lambda overview, table, tube_id: table.columns[token][tube_id]
+        if token in DEFAULT_OVERVIEW:
+            self.overview_inputs.add(token)
+            return lambda overview, table, tube_id: alert_value(overview.get(token))
+        raise ValueError('unknown field {0!r}'.format(token))
+
+
+    def holds(self, overview, table, tube_id, firing):
+        if self.server:
+            value = alert_value(overview.get(self.field))
+        else:
+            value = table.columns[self.field][tube_id]
+        threshold = (self.clear if firing else self.trigger)(overview, table, tube_id)
+        # NaN, a missing value, never satisfies a comparison.
+        return value == value and threshold == threshold and self.compare(value, threshold)
+
+
+
+def alert_value(value):
+    if isinstance(value, (int, float)):
+        return value
+    return INFINITY if value == GROWING else NAN
+
+
+def parse_alert_rules(path):
+    """
+    Compile the rules in the file at `path`, one per line with '#'
+    comments, raising ValueError with the line number of a bad one.
+    """
+    rules = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            name, _, spec = line.partition(':')
+            words = spec.split()
+            try:
+                server = bool(words) and words[0] == 'server'
+                if server:
+                    words = words[1:]
+                if len(words) < 3 or len(words) % 2 == 0 or not name.strip():
+                    raise ValueError('expected NAME: FIELD OP VALUE')
+                field, op, value = words[:3]
+                extra = dict(zip(words[3::2], words[4::2]))
+                unknown = set(extra) - set(['clear', 'for', 'cooldown'])
+                if unknown:
+                    raise ValueError('unknown keyword {0!r}'.format(sorted(unknown)[0]))
+                rules.append(AlertRule(
+                    name.strip(), field, op, value,
+                    clear=extra.get('clear'),
+                    hold=float(extra.get('for', 0)),
+                    cooldown=float(extra.get('cooldown', ALERT_COOLDOWN)),
+                    server=server))
+            except ValueError as e:
+                raise ValueError('{0}:{1}: {2}'.format(path, number, e))
+    return rules
+
+
+
+class AlertEngine(object):
+    """
+    Evaluates AlertRules against each TubeTable. A tube is only looked
+    at again when one of its rule's inputs changed since the previous
+    table, or while a `for` hold is running down, so quiet tubes cost
+    nothing however many rules there are. update() returns the
+    ('firing'|'resolved', rule, tube, value) events that are due,
+    firings no more than once per cooldown for each rule and tube.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.firing = frozenset()
+        self._pending = [{} for _ in rules]
+        self._active = [set() for _ in rules]
+        self._notified = [{} for _ in rules]
+        self._table = None
+        self._overview = {}
+
+
+    def __bool__(self):
+        return bool(self.rules)
+
+
+    def update(self, overview, table, now):
+        previous, self._table = self._table, table
+        previous_overview, self._overview = self._overview, overview
+        if previous is not None and previous.tube_ids is not table.tube_ids:
+            previous = None
+
+        moved = False
+        changed = {}
+        events = []
+        for r, rule in enumerate(self.rules):
+            if rule.server:
+                candidates = [None]
+            elif previous is None or any(
+                    overview.get(key) != previous_overview.get(key) for key in rule.overview_inputs):
+                candidates = list(range(len(table.present)))
+            else:
+                candidates = set()
+                for column in rule.table_inputs:
+                    if column not in changed:
+                        changed[column] = table.changed(previous, column)
+                    candidates.update(changed[column])
+
+            pending, active = self._pending[r], self._active[r]
+            for tube_id in candidates:
+                name = '*' if tube_id is None else table.names[tube_id]
+                present = tube_id is None or (table.present[tube_id] and not table.host_rows[tube_id])
+                if present and rule.holds(overview, table, tube_id, name in active):
+                    if name not in active:
+                        pending.setdefault(name, now)
+                elif name in active:
+                    active.discard(name)
+                    moved = True
+                    events.extend(self._resolve(r, name, overview, table))
+                else:
+                    pending.pop(name, None)
+
+        if previous is None:
+            # Tubes that left with the old ids are no longer listed.
+            listed = set(table.names[tube_id] for tube_id in table.rows)
+            listed.add('*')
+            for r in range(len(self.rules)):
+                pending, active, notified = self._pending[r], self._active[r], self._notified[r]
+                for name in [name for name in pending if name not in listed]:
+                    del pending[name]
+                for name in [name for name in notified if name not in listed and name not in active]:
+                    del notified[name]
+                for name in [name for name in active if name not in listed]:
+                    active.discard(name)
+                    moved = True
+                    events.extend(self._resolve(r, name, overview, table))
+
+        # Holds run down whether or not their tube changed.
+        for r, rule in enumerate(self.rules):
+            pending, active = self._pending[r], self._active[r]
+            for name, since in list(pending.items()):
+                if now - since >= rule.hold:
+                    del pending[name]
+                    active.add(name)
+                    moved = True
+                    events.extend(self._fire(r, name, now, overview, table))
+
+        # A resolved tube is only remembered until its cooldown is over.
+        for r, rule in enumerate(self.rules):
+            pending, active, notified = self._pending[r], self._active[r], self._notified[r]
+            if len(notified) > len(active):
+                for name in [name for name, (last, _) in notified.items()
+                             if name not in active and name not in pending and now - last >= rule.cooldown]:
+                    del notified[name]
+
+        if moved:
+            self.firing = frozenset().union(*self._active)
+        return events
+
+
+    def _value(self, rule, name, overview, table):
+        if rule.server:
+            return overview.get(rule.field)
+        tube_id = table.tube_ids.lookup(name)
+        if tube_id is None or tube_id >= len(table.present) or not table.present[tube_id]:
+            return '-'
+        return table.format_value(tube_id, rule.field)
+
+
+    def _fire(self, r, name, now, overview, table):
+        rule, notified = self.rules[r], self._notified[r]
+        last = notified.get(name)
+        if last is not None and now - last[0] < rule.cooldown:
+            return []
+        notified[name] = (now, True)
+        return [('firing', rule, name, self._value(rule, name, overview, table))]
+
+
+    def _resolve(self, r, name, overview, table):
+        rule, notified = self.rules[r], self._notified[r]
+        last = notified.get(name)
+        if last is None or not last[1]:
+            return []
+        notified[name] = (last[0], False)
+        return [('resolved', rule, name, self._value(rule, name, overview, table))]
+
+
+    def server_alerts(self):
+        return [rule.name for rule, active in zip(self.rules, self._active) if '*' in active]
+
+
+
+class AlertActions(object):
+    """
+    Hands each alert event to `command`, run through the shell with
+    the event in BEANSTALKTOP_ALERT_* environment variables, and writes
+    it as a JSON line to the FIFO at `fifo` when something is reading
+    it. Neither is waited on, so a slow handler can't hold up a tick.
+    """
+
+    def __init__(self, command=None, fifo=None):
+        self.command = command
+        self.fifo = fifo
+        self._children = []
+        self._fifo_fd = None
+
+
+    def __call__(self, timestamp, events):
+        self._children = [child for child in self._children if child.poll() is None]
+        for state, rule, tube, value in events:
+            event = {
+                'time': timestamp,
+                'state': state,
+                'rule': rule.name,
+                'condition': rule.text,
+                'tube': tube,
+                'value': value,
+                }
+            if self.command:
+                environment = dict(os.environ)
+                environment.update(
+                    ('BEANSTALKTOP_ALERT_' + key.upper(), str(value)) for key, value in event.items())
+                self._children.append(subprocess.Popen(
+                    self.command, shell=True, env=environment, stdin=subprocess.DEVNULL))
+            if self.fifo:
+                self._write_fifo(json.dumps(event, sort_keys=True) + '\n')
+
+
+    def _write_fifo(self, text):
+        # The FIFO stays open between events so that a reader doesn't
+        # see end of file after each one.
+        if self._fifo_fd is None:
+            try:
+                self._fifo_fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # ENXIO: nobody has the FIFO open for reading.
+                if e.errno != errno.ENXIO:
+                    raise
+                return
+        try:
+            os.write(self._fifo_fd, text.encode('utf-8'))
+        except BlockingIOError:
+            pass
+        except BrokenPipeError:
+            self.close()
+
+
+    def close(self):
+        if self._fifo_fd is not None:
+            os.close(self._fifo_fd)
+            self._fifo_fd = None
+
+
+
+class AdaptiveInterval(object):
+    """
+    The delay before the next collection in --adaptive mode. It halves
+    while the server is busy enough that every tick sees jobs put,
+    deleted or buried, and grows by half while nothing happens, within
+    [minimum, maximum]. Whatever that says, it is never so short that
+    collecting takes more than `max_load` of the time.
+    """
+
+    def __init__(self, delay, minimum, maximum, max_load):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_load = max_load
+        self.delay = min(maximum, max(minimum, delay))
+
+
+    def next(self, overview, cost):
+        rates = [overview.get(rate) for rate, _, _ in RATE_COUNTERS]
+        rates = [rate for rate in rates if isinstance(rate, (int, float))]
+        if rates:
+            events = sum(rates) * self.delay
+            if events >= 1:
+                self.delay /= 2
+            elif events == 0:
+                self.delay *= 1.5
+        self.delay = min(self.maximum, max(self.minimum, self.delay))
+        self.delay = max(self.delay, cost * (1 - self.max_load) / self.max_load)
+        return self.delay
+
+
+
+def make_interval(options):
+    if not options.adaptive:
+        return None
+    return AdaptiveInterval(
+        options.delay_seconds, options.min_delay, options.max_delay, options.max_load)
+
+
+
+Snapshot = collections.namedtuple('Snapshot', 'overview table timestamp')
+
+
+def freeze_snapshot(overview, lines, timestamp, tube_ids):
+    return Snapshot(
+        types.MappingProxyType(dict(overview)),
+        TubeTable.from_lines(lines, tube_ids),
+        timestamp)
+
+
+
+class BackgroundCollector(threading.Thread):
+    """
+    Calls `collect` every `delay` seconds off the render thread and
+    publishes the result as an immutable Snapshot. A byte is written to
+    `wakeup_fd` after each publish so the render loop can redraw
+    straight away. Given an AdaptiveInterval, `delay` is recalculated
+    after every collection. A collection that raises publishes an empty
+    snapshot, with the reason in `error`, and is tried again after
+    `delay`.
+    """
+
+    live = True
+    cached = False
+    error = None
+
+    def __init__(self, collect, delay, wakeup_fd=None, interval=None):
+        super(BackgroundCollector, self).__init__(name='beanstalktop-collector')
+        self.daemon = True
+        self.collect = collect
+        self.delay = delay if interval is None else interval.delay
+        self.wakeup_fd = wakeup_fd
+        self.interval = interval
+        self.snapshot = None
+        self._tube_ids = TubeIds()
+        self._stopped = threading.Event()
+
+
+    def run(self):
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            try:
+                overview, lines = self.collect()
+                error = None
+            except Exception as e:
+                overview, lines = DEFAULT_OVERVIEW, [DEFAULT_ROW]
+                error = 'collection failed: {0}'.format(e.__class__.__name__)
+            now = time.monotonic()
+            if self.interval is not None and error is None:
+                self.delay = self.interval.next(overview, now - started)
+            self.snapshot = freeze_snapshot(overview, lines, now, self._tube_ids)
+            self._tube_ids = self.snapshot.table.tube_ids
+            self.cached = False
+            self.error = error
+            wake(self.wakeup_fd)
+            self._stopped.wait(self.delay)
+
+
+    def warm(self, overview, lines, age):
+        """
+        Stand in a snapshot from an earlier run, `age` seconds old,
+        until the first collection replaces it.
+        """
+        self.snapshot = freeze_snapshot(overview, lines, time.monotonic() - age, self._tube_ids)
+        self._tube_ids = self.snapshot.table.tube_ids
+        self.cached = True
+
+
+    def clock(self):
+        """
+        The wall time the current snapshot should be judged against.
+        """
+        return time.time()
+
+
+    def stop(self, timeout=0.5):
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+
+class SnapshotCache(object):
+    """
+    The last collection from each host, one compressed JSON file per
+    host and port under `directory`. Only the columns a table shows are
+    kept, a list per column, which is quick to read back. Files are
+    written whole under a temporary name and renamed into place, so a
+    start never reads half of one; one that can't be read is as good
+    as none.
+    """
+
+    fields = ('name',) + TABLE_COLUMNS
+
+    def __init__(self, directory):
+        self.directory = directory
+
+
+    def path(self, host, port):
+        name = re.sub(r'[^\w.-]', '_', '{0}-{1}'.format(host, port))
+        return os.path.join(self.directory, name + '.json.z')
+
+
+    def load(self, host, port):
+        """
+        (wall time saved, overview, rows) for the host, or None.
+        """
+        try:
+            with open(self.path(host, port), 'rb') as f:
+                message = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+            fields = message['fields']
+            lines = [dict(zip(fields, values)) for values in zip(*message['columns'])]
+            return message['time'], message['overview'], lines
+        except (IOError, ValueError, KeyError, TypeError, zlib.error):
+            return None
+
+
+    def save(self, host, port, overview, lines):
+        path = self.path(host, port)
+        temporary = '{0}.{1}'.format(path, os.getpid())
+        message = {
+            'time': time.time(),
+            'overview': overview,
+            'fields': self.fields,
+            'columns': [[line.get(field, '-') for line in lines] for field in self.fields],
+            }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temporary, 'wb') as f:
+                f.write(zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8')))
+            os.replace(temporary, path)
+        except (IOError, OSError):
+            pass
+
+
+
+def default_cache_directory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'beanstalktop')
+
+
+
+class BeanstalkMonitor(object):
+    """
+    Everything needed to collect statistics from the configured hosts,
+    independent of how they end up being shown.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.reserve_latency = LogHistogram()
+        self.total_latency = LogHistogram()
+        self.hosts = [
+            BeanstalkHost(host, port, options, LatencyCanary(
+                host, port, options, self.reserve_latency, self.total_latency)
+                if options.canary else None)
+            for host, port in options.hosts]
+        self.cluster = ClusterCollector(self.hosts)
+        self._canaries = None
+        self.snapshot_cache = options.snapshot_cache
+        self._results = None
+        self._saved_at = -SNAPSHOT_CACHE_INTERVAL
+
+        self.default_overview = DEFAULT_OVERVIEW
+        self.default_row = DEFAULT_ROW
+
+
+    def format_status(self):
+        if len(self.hosts) == 1:
+            return self.hosts[0].format_status()
+        connected = sum(1 for host in self.hosts if host.connection_state == 'connected')
+        status = '{0}/{1} hosts connected'.format(connected, len(self.hosts))
+        failed = [host for host in self.hosts if host.error is not None]
+        if failed:
+            status += '; {0}: {1}'.format(failed[0].label, failed[0].error)
+        return status
+
+
+    def set_tube_filter(self, tube_filter):
+        for host in self.hosts:
+            host.set_tube_filter(tube_filter)
+
+
+    def locate(self, name):
+        """
+        The (host, port, tube) a row stands for, or None for a host row.
+        """
+        if len(self.hosts) == 1:
+            host = self.hosts[0]
+            return host.host, host.port, name
+        label, _, tube = name.partition('/')
+        for host in self.hosts:
+            if tube and host.label == label:
+                return host.host, host.port, tube
+        return None
+
+
+    def set_visible_tubes(self, names):
+        """
+        Tell each host which of its tubes are on screen, so that a tube
+        budget polls those first.
+        """
+        if len(self.hosts) == 1:
+            self.hosts[0].visible_tubes = list(names)
+            return
+        visible = dict((host.label, []) for host in self.hosts)
+        for name in names:
+            label, _, tube = name.partition('/')
+            if tube and label in visible:
+                visible[label].append(tube)
+        for host in self.hosts:
+            host.visible_tubes = visible[host.label]
+
+
+    def get_data(self):
+        """
+        Main statistics
+        {
+        'binlog-current-index': 0,
+        'binlog-max-size': 10485760,
+        'binlog-oldest-index': 0,
+        'binlog-records-migrated': 0,
+        'binlog-records-written': 0,
+        'cmd-bury': 580,
+        'cmd-delete': 15291,
+        'cmd-ignore': 3,
+        'cmd-kick': 0,
+        'cmd-list-tube-used': 0,
+        'cmd-list-tubes': 1,
+        'cmd-list-tubes-watched': 0,
+        'cmd-pause-tube': 0,
+        'cmd-peek': 0,
+        'cmd-peek-buried': 0,
+        'cmd-peek-delayed': 0,
+        'cmd-peek-ready': 0,
+        'cmd-put': 19623,
+        'cmd-release': 0,
+        'cmd-reserve': 0,
+        'cmd-reserve-with-timeout': 15873,
+        'cmd-stats': 1,
+        'cmd-stats-job': 22719,
+        'cmd-stats-tube': 0,
+        'cmd-touch': 0,
+        'cmd-use': 10603,
+        'cmd-watch': 5,
+        'current-connections': 8,
+        'current-jobs-buried': 580,
+        'current-jobs-delayed': 0,
+        'current-jobs-ready': 3750,
+        'current-jobs-reserved': 2,
+        'current-jobs-urgent': 0,
+        'current-producers': 3,
+        'current-tubes': 8,
+        'current-waiting': 0,
+        'current-workers': 3,
+        'job-timeouts': 0,
+        'max-job-size': 65535,
+        'pid': 78938,
+        'rusage-stime': 2.585616,
+        'rusage-utime': 1.005601,
+        'total-connections': 8,
+        'total-jobs': 19623,
+        'uptime': 156,
+        'version': 1.6,
+        }
+
+        Tube-specific statistics
+        {
+        'cmd-delete': 892,
+        'cmd-pause-tube': 0,
+        'current-jobs-buried': 685,
+        'current-jobs-delayed': 0,
+        'current-jobs-ready': 1001,
+        'current-jobs-reserved': 1,
+        'current-jobs-urgent': 0
+        'current-using': 0,
+        'current-waiting': 0,
+        'current-watching': 1,
+        'name': 'default',
+        'pause': 0,
+        'pause-time-left': 0,
+        'total-jobs': 2579,
+        }
+        """
+        if self._canaries is None:
+            # Probing starts with collecting, not when the monitor is made.
+            self._canaries = [host.canary for host in self.hosts if host.canary is not None]
+            for canary in self._canaries:
+                canary.start()
+        results = self.cluster.collect()
+        self.options.instruments.end_tick()
+        self._results = results
+        if self.snapshot_cache is not None and time.monotonic() - self._saved_at >= SNAPSHOT_CACHE_INTERVAL:
+            self.save_snapshots()
+        overview, lines = self.combine(results)
+        if self.options.canary:
+            overview = dict(overview)
+            overview['probe-reserve'] = self.reserve_latency.format()
+            overview['probe-total'] = self.total_latency.format()
+        return overview, lines
+
+
+    def save_snapshots(self):
+        self._saved_at = time.monotonic()
+        for host, (overview, lines) in zip(self.hosts, self._results or ()):
+            if overview is not None:
+                self.snapshot_cache.save(host.host, host.port, overview, lines)
+
+
+    def cached_data(self):
+        """
+        The overview and table the last run collected, put together
+        from each host's cached collection as a live one would be, and
+        the wall time of the oldest; None without any. Rows carry that
+        time as 'refreshed-at' unless they have their own.
+        """
+        results, times = [], []
+        for host in self.hosts:
+            cached = self.snapshot_cache.load(host.host, host.port)
+            if cached is None:
+                results.append((None, None))
+                continue
+            saved, overview, lines = cached
+            lines = filter_lines(self.options.tube_filter, lines)
+            for line in lines:
+                line.setdefault('refreshed-at', saved)
+            results.append((overview, lines))
+            times.append(saved)
+        if not times:
+            return None
+        overview, lines = self.combine(results)
+        return overview, lines, min(times)
+
+
+    def combine(self, results):
+        """
+        Turn the per-host results of a cluster collection into a single
+        overview and table.
+        """
+        if len(self.hosts) == 1:
+            overview, lines = results[0]
+            if overview is None:
+                return self.default_overview, [self.default_row]
+            return overview, lines
+
+        return self._aggregate(results)
+
+
+    def _aggregate(self, results):
+        """
+        Sum the overview fields across hosts and prefix each tube with
+        the host it lives on; every host also gets a row of its own
+        server-wide counts, kept at the top of the table.
+        """
+        overview = dict((key, 0) for key in self.default_overview)
+        overview['pid'] = '-'
+        rate_keys = set(key for key, _, _ in RATE_COUNTERS)
+        uptimes = []
+        lines = []
+
+        for host, (host_overview, host_lines) in zip(self.hosts, results):
+            row = dict(self.default_row, name=host.label, **{'host-row': True})
+            if host_overview is None:
+                lines.append(row)
+                continue
+
+            for key in overview:
+                value = host_overview.get(key, 0)
+                if key == 'pid' or overview[key] == '-':
+                    continue
+                if isinstance(value, (int, float)):
+                    overview[key] += value
+                elif key in rate_keys:
+                    # A sum missing a host's rate is no rate at all:
+                    # shown as 0 it reads as an idle cluster.
+                    overview[key] = '-'
+            uptimes.append(host_overview.get('uptime', 0))
+
+            row.update((key, host_overview.get(key, '-')) for key in self.default_row if key != 'name')
+            lines.append(row)
+            lines.extend(dict(line, name='{0}/{1}'.format(host.label, line['name']))
+                         for line in host_lines)
+
+        if not uptimes:
+            return self.default_overview, lines
+
+        overview['uptime'] = min(uptimes)
+        return overview, lines
+
+
+    def close(self):
+        if self.snapshot_cache is not None:
+            self.save_snapshots()
+        self.cluster.close()
+        for canary in self._canaries or ():
+            canary.stop()
+
+
+
+class BeanstalkTopUI(object):
+
+    def __init__(self, win, options):
+        self.win = win
+        self.options = options
+        self.frame_time = 0.0
+        self._untimed_frames = ['first-frame', 'first-live-frame']
+        self.resize()
+        try:
+            curses.use_default_colors()
+            curses.start_color()
+            curses.curs_set(0)
+        except curses.error:
+            pass
+
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self.history = History(options.history, options.history_expiry)
+        self.tube_filter = options.tube_filter
+        self.show_instruments = False
+        self._filter_row = 0
+        self.sparkline_chars = SPARKLINE_CHARS
+        self.sort_markers = {True: u'\u25bc', False: u'\u25b2'}
+        if 'utf' not in (locale.getpreferredencoding(False) or '').lower():
+            self.sparkline_chars = SPARKLINE_CHARS_ASCII
+            self.sort_markers = {True: 'v', False: '^'}
+
+        self._set_sort('current-jobs-ready', True)
+        self._default_table = None
+        self.alerts = AlertEngine(options.alert_rules)
+
+        self.selected = None
+        self.drill_down = None
+        self.job_cache = JobStatsCache()
+        self.inspector = None
+        self._visible_names = []
+        self.action = None
+
+        self.recorder = None
+        self._track_visible = False
+        if options.replay:
+            # A replay is its own source and collector.
+            self.monitor = self.collector = ReplayCollector(
+                Recording(options.replay), self.history, options.tube_filter,
+                self._wakeup_w)
+        else:
+            self.monitor = make_source(options)
+            self._track_visible = bool(options.tube_budget) and isinstance(self.monitor, BeanstalkMonitor)
+            if options.record:
+                self.recorder = SessionRecorder(options.record)
+            # A relay paces itself, so don't add a delay on top of it.
+            self.collector = BackgroundCollector(
+                self.collect, 0 if options.relay else options.delay_seconds,
+                self._wakeup_w, None if options.relay else make_interval(options))
+            if isinstance(self.monitor, BeanstalkMonitor) and self.monitor.snapshot_cache is not None:
+                cached = self.monitor.cached_data()
+                if cached is not None:
+                    overview, lines, saved = cached
+                    self.collector.warm(overview, lines, max(0.0, time.time() - saved))
+
+
+    def run(self):
+        poll = select.poll()
+        poll.register(sys.stdin.fileno(), select.POLLIN | select.POLLPRI)
+        poll.register(self._wakeup_r, select.POLLIN)
+        self.collector.start()
+        while 1:
+            self.resize()
+            self.refresh_display()
+
+            try:
+                # Wake at least once a second so the staleness age keeps
+                # counting up while the collector is stuck.
+                events = poll.poll(min(1.0, self.options.delay_seconds) * 1000.0)
+            except select.error as e:
+                if e.args and e.args[0] == errno.EINTR:
+                    events = []
+                else:
+                    raise
+            except KeyboardInterrupt:
+                break
+
+            for fd, _ in events:
+                if fd == self._wakeup_r:
+                    self._drain_wakeups()
+                else:
+                    key = self.win.getch()
+                    self.handle_key(key)
+
+
+    def _drain_wakeups(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError:
+            pass
+
+
+    def close(self):
+        self.collector.stop()
+        if self.inspector is not None:
+            self.inspector.stop()
+        if self.action is not None:
+            self.action.stop()
+        # The event loop can only be closed once nothing is running on it;
+        # a collector still stuck on a socket dies with the process instead.
+        if not self.collector.is_alive():
+            self.monitor.close()
+            if self.recorder is not None:
+                self.recorder.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+
+    def handle_key(self, key):
+        key_bindings = {
+            ord('q'): lambda: sys.exit(0),
+            ord('Q'): lambda: sys.exit(0),
+            ord('<'): lambda: self._move_sort_column(-1),
+            ord('>'): lambda: self._move_sort_column(1),
+            ord('r'): self._reverse_sort,
+            ord('/'): self._prompt_filter,
+            ord('i'): self._toggle_instruments,
+            curses.KEY_UP: lambda: self._move_selection(-1),
+            curses.KEY_DOWN: lambda: self._move_selection(1),
+            ord('\n'): self._toggle_drill_down,
+            ord('\r'): self._toggle_drill_down,
+            curses.KEY_ENTER: self._toggle_drill_down,
+            27: self._close_drill_down,
+            ord('k'): lambda: self._start_action('kick'),
+            ord('p'): lambda: self._start_action('pause'),
+            ord('D'): lambda: self._start_action('drain'),
+            ord('x'): self._cancel_action,
+            }
+        if self.options.replay:
+            replay = self.collector
+            key_bindings.update({
+                ord(' '): replay.toggle_pause,
+                ord('+'): lambda: replay.change_speed(2.0),
+                ord('-'): lambda: replay.change_speed(0.5),
+                curses.KEY_LEFT: lambda: replay.seek(-REPLAY_SEEK_STEP),
+                curses.KEY_RIGHT: lambda: replay.seek(REPLAY_SEEK_STEP),
+                ord('['): lambda: replay.seek(-10 * REPLAY_SEEK_STEP),
+                ord(']'): lambda: replay.seek(10 * REPLAY_SEEK_STEP),
+                })
+
+        action = key_bindings.get(key, lambda: None)
+        action()
+
+
+    def _toggle_instruments(self):
+        self.show_instruments = not self.show_instruments
+
+
+    def _move_selection(self, step):
+        names = self._visible_names
+        if not names:
+            return
+        position = names.index(self.selected) + step if self.selected in names else 0
+        self.selected = names[max(0, min(len(names) - 1, position))]
+
+
+    def _toggle_drill_down(self):
+        """
+        Open the job view on the selected tube, or close it again. Only
+        a live source has a server to ask.
+        """
+        if self.drill_down is not None:
+            self._close_drill_down()
+            return
+        location = None
+        if self.selected is not None and isinstance(self.monitor, BeanstalkMonitor):
+            location = self.monitor.locate(self.selected)
+        if location is None:
+            curses.beep()
+            return
+        if self.inspector is None or not self.inspector.is_alive():
+            self.inspector = JobInspector(self.options, self.job_cache, self._wakeup_w)
+            self.inspector.start()
+        self.inspector.inspect(*location)
+        self.drill_down = self.selected
+
+
+    def _close_drill_down(self):
+        if self.inspector is not None:
+            self.inspector.stop_inspecting()
+        self.drill_down = None
+
+
+    def _format_drill_down(self):
+        """
+        The job view: a line about the tube, the column headings, and a
+        row for each of its next ready, delayed and buried jobs.
+        """
+        layout = ' {0:<9}{1:>12}{2:>10}{3:>12}{4:>10}{5:>10}{6:>8}{7:>10}  {8}'
+        lines = [(' Next jobs in {0}, looked at every {1:.0f}s; Enter or Esc returns'.format(
+            self.drill_down, DRILL_DOWN_INTERVAL), curses.A_NORMAL)]
+        lines.append((layout.format(
+            'STATE', 'JOB', 'AGE', 'PRI', 'RESERVES', 'TIMEOUTS', 'BURIES', 'LEFT', 'BODY'), curses.A_REVERSE))
+
+        jobs, error = self.inspector.jobs, self.inspector.error
+        if error is not None or not jobs:
+            message = error or ('looking...' if jobs is None else 'no ready, delayed or buried jobs')
+            lines.append((' ' + message, curses.A_NORMAL))
+            return lines
+
+        for state, jid, stats, preview in jobs:
+            durations = [stats.get(key) for key in ('age', 'time-left')]
+            durations = [format_duration(d) if isinstance(d, int) else '-' for d in durations]
+            lines.append((layout.format(
+                state, '-' if jid is None else jid, durations[0], stats.get('pri', '-'),
+                stats.get('reserves', '-'), stats.get('timeouts', '-'), stats.get('buries', '-'),
+                durations[1], preview), curses.A_NORMAL))
+        return lines
+
+
+    def _start_action(self, kind):
+        """
+        Ask how much to kick, pause or delete in the tube being looked at,
+        or else the selected one, and start doing it in the background.
+        One action runs at a time, and only a live source has a server
+        to act on.
+        """
+        name = self.drill_down if self.drill_down is not None else self.selected
+        location = None
+        if name is not None and isinstance(self.monitor, BeanstalkMonitor):
+            location = self.monitor.locate(name)
+        if location is None or (self.action is not None and self.action.is_alive()):
+            curses.beep()
+            return
+
+        prompts = {
+            'kick': 'Kick how many buried jobs from {0} (a number or all): ',
+            'pause': 'Pause {0} for how many seconds (0 resumes): ',
+            'drain': 'DELETE how many buried jobs from {0} (a number or all): ',
+            }
+        text = self._prompt(prompts[kind].format(location[2])).strip().lower()
+        if not text:
+            return
+        if text == 'all' and kind != 'pause':
+            count = None
+        elif text.isdigit():
+            count = int(text)
+        else:
+            curses.beep()
+            return
+        self.action = TubeAction(self.options, kind, *location, count=count, wakeup_fd=self._wakeup_w)
+        self.action.start()
+
+
+    def _cancel_action(self):
+        if self.action is not None and self.action.is_alive():
+            self.action.cancel()
+
+
+    def _format_action(self):
+        """
+        The header line for the running action: a bar of what's been
+        moved against what's left buried, or how it ended.
+        """
+        action = self.action
+        if action.kind == 'pause':
+            if action.finished_at is None:
+                return ' Pausing {0}...'.format(action.tube)
+            if action.error is not None:
+                return ' Pause of {0}: {1}'.format(action.tube, action.error)
+            if not action.count:
+                return ' Resumed {0}'.format(action.tube)
+            return ' Paused {0} for {1}'.format(action.tube, format_duration(action.count))
+
+        verb = {'kick': 'Kick', 'drain': 'Delete'}[action.kind]
+        done = '{0:,} of {1}'.format(action.done, '?' if action.total is None else '{0:,}'.format(action.total))
+        buried = '' if action.buried is None else ', {0:,} buried'.format(action.buried)
+        if action.finished_at is None:
+            width = max(10, min(40, self.width // 4))
+            filled = int(width * action.done / action.total) if action.total else 0
+            return ' {0} {1} [{2}] {3}{4} at {5:g}/s; x cancels{6}'.format(
+                verb, action.tube, '#' * filled + '-' * (width - filled), done, buried,
+                action.rate, ', stopping' if action.cancelled else '')
+        outcome = action.error or ('cancelled' if action.cancelled else 'done')
+        return ' {0} {1}: {2}, {3}{4}'.format(verb, action.tube, outcome, done, buried)
+
+
+    def _format_instruments(self):
+        """
+        The overlay: recent percentiles of each timed phase, and of the
+        bytes and commands per tick.
+        """
+        layout = ' {0:<15}{1:>11}{2:>11}{3:>11}{4:>9}'
+        lines = [layout.format('PHASE', 'P50', 'P99', 'MAX', 'SAMPLES')]
+        for name, unit in INSTRUMENTS:
+            summary = self.options.instruments.summary(name)
+            if summary is None:
+                values = ['-', '-', '-', 0]
+            else:
+                values = [format_instrument_value(value, unit) for value in summary[:3]]
+                values.append(summary[3])
+            lines.append(layout.format(name if unit == 'us' else name + '/tick', *values))
+        return lines
+
+
+    def _prompt_filter(self):
+        """
+        Read a new tube filter. Empty input clears the filter; one that
+        doesn't compile is refused.
+        """
+        text = self._prompt('Filter (glob, re:REGEX, !exclude): ')
+        try:
+            tube_filter = TubeFilter.parse(text)
+        except re.error:
+            curses.beep()
+            return
+        self.tube_filter = tube_filter
+        self.monitor.set_tube_filter(tube_filter)
+
+
+    def _prompt(self, prompt):
+        """
+        Read a line of input on the line under the summary.
+        """
+        y = self._filter_row
+        self.win.move(y, 0)
+        self.win.clrtoeol()
+        self.win.addstr(y, 0, prompt[:self.width - 1])
+        curses.echo()
+        try:
+            curses.curs_set(1)
+        except curses.error:
+            pass
+        try:
+            text = self.win.getstr(y, min(len(prompt), self.width - 1))
+        finally:
+            curses.noecho()
+            try:
+                curses.curs_set(0)
+            except curses.error:
+                pass
+            # The prompt drew over the screen behind _draw's back.
+            self._frame = []
+        return text.decode(locale.getpreferredencoding(False), 'replace')
+
+
+    def _move_sort_column(self, step):
+        position = SORTABLE_COLUMNS.index(self.sort_index.column)
+        column = SORTABLE_COLUMNS[(position + step) % len(SORTABLE_COLUMNS)]
+        self._set_sort(column, self.sort_index.descending)
+
+
+    def _reverse_sort(self):
+        self._set_sort(self.sort_index.column, not self.sort_index.descending)
+
+
+    def _set_sort(self, column, descending):
+        self.sort_index = SortedIndex(column, descending)
+        self._indexed_table = None
+
+
+    def resize(self):
+        height, width = self.win.getmaxyx()
+        if (height, width) != (getattr(self, 'height', None), getattr(self, 'width', None)):
+            self._frame = []
+            self.win.erase()
+        self.height, self.width = height, width
+
+
+    def _refresh_interval(self):
+        """
+        The time between collections as it stands, for judging how old
+        a snapshot is.
+        """
+        if self.options.relay or self.options.replay:
+            return self.options.delay_seconds
+        return self.collector.delay
+
+
+    def refresh_display(self):
+        started = time.perf_counter()
+
+        snapshot = self.collector.snapshot
+        if snapshot is None:
+            if self._default_table is None:
+                self._default_table = TubeTable.from_lines([self.monitor.default_row], TubeIds())
+            overview, table = self.monitor.default_overview, self._default_table
+            status = 'connecting'
+        else:
+            overview, table = snapshot.overview, snapshot.table
+            status = self.monitor.format_status()
+            age = time.monotonic() - snapshot.timestamp
+            if self.collector.error is not None:
+                status = self.collector.error
+            elif self.collector.cached:
+                status = 'connecting, cached {0} ago'.format(format_duration(age))
+            elif self.collector.live and age > STALE_AFTER_INTERVALS * max(1.0, self._refresh_interval()):
+                status += ', stale ({0:.0f}s old)'.format(age)
+        overview = dict(overview, status=status)
+        overview['frame-time'] = '{0:.1f}ms'.format(self.frame_time * 1000.0)
+        overview['interval'] = '{0:.2f}s'.format(self._refresh_interval())
+
+        items = SUMMARY_ITEMS + ('Frame: {frame-time}', 'Interval: {interval}')
+        if 'probe-reserve' in overview:
+            items += ('Probe reserve: {probe-reserve}', 'Probe total: {probe-total}')
+        summary_items = format_summary(overview, items)
+
+        summary_lines = [summary_items[i:i + 3] for i in range(0, len(summary_items), 3)]
+
+        summarywidth = self.width // max(len(i) for i in summary_lines)
+
+        frame = []
+        for item in summary_lines:
+            line = ''.join(s.ljust(summarywidth) for s in item)
+            frame.append((line[:self.width].ljust(self.width), curses.A_NORMAL))
+
+        if table is not self._indexed_table:
+            self.sort_index.update(table)
+            if self.alerts:
+                self.alerts.update(overview, table, self.collector.clock())
+            self._indexed_table = table
+
+        self._filter_row = len(frame)
+        filter_line = []
+        if self.tube_filter:
+            filter_line.append('Filter: {0}'.format(self.tube_filter))
+        if self.alerts.firing:
+            filter_line.append('Alerts: {0} firing'.format(len(self.alerts.firing)))
+            server_alerts = self.alerts.server_alerts()
+            if server_alerts:
+                filter_line[-1] += ' ({0})'.format(', '.join(server_alerts))
+        filter_line = '    '.join(filter_line)
+        frame.append((filter_line[:self.width].ljust(self.width), curses.A_NORMAL))
+
+        if self.action is not None and (self.action.finished_at is None or
+                                        time.monotonic() - self.action.finished_at < ACTION_RESULT_SECONDS):
+            frame.append((self._format_action()[:self.width].ljust(self.width), curses.A_BOLD))
+
+        if self.show_instruments:
+            for line in self._format_instruments():
+                frame.append((line[:self.width].ljust(self.width), curses.A_BOLD))
+
+        # Numeric columns never need more than NUMERIC_COLUMN_WIDTH; any
+        # space left over goes to the tube name.
+        colwidth = min(self.width // len(COLUMNS) + 1, NUMERIC_COLUMN_WIDTH + 1)
+        namewidth = max(colwidth, self.width - (len(COLUMNS) - 1) * (colwidth - 1) + 1)
+
+        if self.drill_down is not None:
+            for line, attr in self._format_drill_down():
+                frame.append((line[:self.width].ljust(self.width), attr))
+            if self._track_visible:
+                self.monitor.set_visible_tubes([self.drill_down])
+        else:
+            title = ''
+            for i, (column, heading) in enumerate(COLUMNS):
+                if column == self.sort_index.column:
+                    heading += self.sort_markers[self.sort_index.descending]
+                if i == 0:
+                    title += (' ' + heading).ljust(namewidth - 1)
+                else:
+                    title += (heading + ' ').rjust(colwidth - 1)
+
+            frame.append((title[:self.width].ljust(self.width), curses.A_REVERSE))
+
+            max_lines = max(0, self.height - len(frame))
+
+            # Rows a tube budget hasn't got round to lately are dimmed.
+            stale_before = self.collector.clock() - (
+                STALE_AFTER_INTERVALS * max(1.0, self._refresh_interval()))
+            refreshed_at = table.columns['refreshed-at']
+
+            visible = self.sort_index.head(max_lines)
+            self._visible_names = [table.names[tube_id] for tube_id in visible]
+            if self._track_visible:
+                self.monitor.set_visible_tubes(self._visible_names)
+
+            for tube_id in visible:
+                name = table.names[tube_id]
+                row = ''
+                for c, (column, _) in enumerate(COLUMNS):
+                    if c == 0:
+                        row += (' ' + name)[:namewidth - 1].ljust(namewidth - 1)
+                    elif column == 'trend':
+                        row += ' ' + self.history.sparkline(
+                            name, 'current-jobs-ready', colwidth - 3,
+                            self.sparkline_chars).rjust(colwidth - 3) + ' '
+                    else:
+                        row += (table.format_value(tube_id, column) + ' ').rjust(colwidth - 1)
+                attr = curses.A_NORMAL
+                if name == self.selected:
+                    attr = curses.A_REVERSE
+                elif name in self.alerts.firing:
+                    attr = curses.A_STANDOUT
+                elif refreshed_at[tube_id] < stale_before:
+                    attr = curses.A_DIM
+                frame.append((row[:self.width].ljust(self.width), attr))
+
+        self._draw(frame)
+        self.frame_time = time.perf_counter() - started
+        self.options.instruments.record_time('render', self.frame_time)
+
+        # Time from start up to the first frame with anything in it, and
+        # to the first with live data, which is the same one without a
+        # cached snapshot to show first.
+        if snapshot is not None and self._untimed_frames:
+            for name in list(self._untimed_frames):
+                if name == 'first-frame' or not self.collector.cached:
+                    self.options.instruments.record_time(name, time.monotonic() - STARTED)
+                    self._untimed_frames.remove(name)
+
+
+    def _draw(self, frame):
+        """
+        Write only the screen lines that differ from the previous frame;
+        curses then sends just those cells to the terminal.
+        """
+        previous = self._frame
+        for y, line in enumerate(frame):
+            if y < len(previous) and previous[y] == line:
+                continue
+            text, attr = line
+            try:
+                self.win.addstr(y, 0, text, attr)
+            except curses.error:
+                # Writing the bottom-right cell moves the cursor off
+                # screen, which curses reports as an error after drawing.
+                pass
+        for y in range(len(frame), min(len(previous), self.height)):
+            self.win.move(y, 0)
+            self.win.clrtoeol()
+        self._frame = frame
+        self.win.refresh()
+
+
+    def collect(self):
+        overview, lines = self.monitor.get_data()
+        self.history.record(lines, time.monotonic())
+        if self.recorder is not None:
+            self.recorder.write(time.time(), overview, lines, self.monitor.format_status())
+        return overview, lines
+
+
+
+def run_beanstalktop_window(win, options):
+    ui = BeanstalkTopUI(win, options)
+    try:
+        ui.run()
+    finally:
+        ui.close()
+
+
+def parse_hosts(hosts, hosts_file, default_port):
+    """
+    Turn --host values and the lines of a hosts file (host[:port], with
+    '#' comments) into a list of (host, port) pairs.
+    """
+    entries = list(hosts or [])
+    if hosts_file:
+        with open(hosts_file) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    entries.append(line)
+    if not entries:
+        entries = ['0.0.0.0']
+
+    parsed = []
+    for entry in entries:
+        host, _, port = entry.rpartition(':')
+        if not host or not port.isdigit():
+            host, port = entry, default_port
+        parsed.append((host, int(port)))
+    return parsed
+
+
+def run_beanstalktop(options):
+    return curses.wrapper(run_beanstalktop_window, options)
+
+
+def format_json_record(timestamp, overview, lines):
+    return json.dumps({
+        'time': timestamp,
+        'overview': dict(overview),
+        'tubes': [dict(line) for line in lines],
+        }, sort_keys=True) + '\n'
+
+
+def format_csv_record(timestamp, overview, lines, header=False):
+    """
+    One row per tube, plus a row named '*' with the server-wide
+    figures, all stamped with the time of the tick.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    if header:
+        writer.writerow(('time', 'name') + RECORD_FIELDS)
+    writer.writerow([timestamp, '*'] + [overview.get(f, '-') for f in RECORD_FIELDS])
+    for line in lines:
+        writer.writerow([timestamp, line['name']] + [line.get(f, '-') for f in RECORD_FIELDS])
+    return buf.getvalue()
+
+
+def format_text_record(timestamp, overview, lines, index):
+    """
+    The summary and the full tube table, laid out like the curses view
+    but with every tube listed, followed by a blank line.
+    """
+    table = TubeTable.from_lines(lines, index.tube_ids)
+    index.update(table)
+    rows = index.head(len(table))
+    namewidth = max([len(table.names[tube_id]) for tube_id in rows] + [len('TUBE')]) + 1
+    items = format_summary(overview)
+
+    out = [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))]
+    out.extend('  '.join(items[i:i + 3]) for i in range(0, len(items), 3))
+    out.append('')
+    out.append('TUBE'.ljust(namewidth) + ''.join(
+        heading.rjust(NUMERIC_COLUMN_WIDTH) for column, heading in COLUMNS
+        if column in RECORD_FIELDS))
+    for tube_id in rows:
+        out.append(table.names[tube_id].ljust(namewidth) + ''.join(
+            table.format_value(tube_id, f).rjust(NUMERIC_COLUMN_WIDTH) for f in RECORD_FIELDS))
+    return '\n'.join(out) + '\n\n'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    return '{' + ','.join(
+        '{0}="{1}"'.format(key, escape_label_value(value)) for key, value in labels) + '}'
+
+
+
+class MetricsExporter(object):
+    """
+    Renders the OpenMetrics exposition once per collection; scrapes only
+    ever read the cached `body`, so they never reach a beanstalkd
+    server. At most `max_tubes` tubes per host get their own labels,
+    the rest are summed into tube="__other__".
+
+    A tube keeps its labels for as long as it exists, and a free place
+    goes to the unlabelled tube with the most ready jobs, so series
+    don't move in and out of __other__ from one scrape to the next. The
+    sums in __other__ still drop whenever one of its tubes goes away,
+    so its job and delete totals are gauges, not counters.
+    """
+
+    def __init__(self, monitor, max_tubes):
+        self.monitor = monitor
+        self.max_tubes = max_tubes
+        self.body = b'# EOF\n'
+        self._labelled = {}
+
+
+    def collect(self):
+        # Through get_data, like every other front end, so that canaries
+        # start and instrument ticks end; its per-host results are what
+        # the exposition is rendered from.
+        started = time.monotonic()
+        data = self.monitor.get_data()
+        self.body = self.render(self.monitor._results, time.monotonic() - started).encode('utf-8')
+        return data
+
+
+    def render(self, results, duration):
+        families = collections.OrderedDict()
+
+        def add(name, kind, help, labels, value):
+            if not isinstance(value, (int, float)):
+                return
+            if name not in families:
+                families[name] = ['# TYPE {0} {1}'.format(name, kind),
+                                  '# HELP {0} {1}'.format(name, help)]
+            sample = name + '_total' if kind == 'counter' else name
+            families[name].append('{0}{1} {2}'.format(sample, format_labels(labels), value))
+
+        for host, (overview, lines) in zip(self.monitor.hosts, results):
+            server = (('host', host.label),)
+            add('beanstalkd_up', 'gauge', 'Whether the last collection succeeded.',
+                server, 0 if overview is None else 1)
+            if overview is None:
+                continue
+
+            for name, kind, key, help in SERVER_METRICS:
+                add(name, kind, help, server, overview.get(key))
+            for state in JOB_STATES:
+                add('beanstalkd_current_jobs', 'gauge', 'Jobs currently in each state.',
+                    server + (('state', state),), overview.get('current-jobs-' + state))
+            for key in sorted(overview):
+                if key.startswith('cmd-'):
+                    add('beanstalkd_commands', 'counter', 'Commands received, by command.',
+                        server + (('command', key[4:]),), overview.get(key))
+
+            tubes, other = self._capped_tubes(host.label, lines)
+            for tube, line in tubes:
+                labels = server + (('tube', tube),)
+                for state in JOB_STATES:
+                    add('beanstalkd_tube_current_jobs', 'gauge', 'Jobs currently in each state, by tube.',
+                        labels + (('state', state),), line.get('current-jobs-' + state))
+                add('beanstalkd_tube_jobs', 'counter', 'Jobs created in the tube.',
+                    labels, line.get('total-jobs'))
+                add('beanstalkd_tube_deletes', 'counter', 'Delete commands for jobs in the tube.',
+                    labels, line.get('cmd-delete'))
+            if other is not None:
+                labels = server + (('tube', '__other__'),)
+                for state in JOB_STATES:
+                    add('beanstalkd_tube_current_jobs', 'gauge', 'Jobs currently in each state, by tube.',
+                        labels + (('state', state),), other.get('current-jobs-' + state))
+                add('beanstalkd_other_tubes_jobs', 'gauge',
+                    'Jobs created in the tubes without labels of their own, as they stand.',
+                    labels, other.get('total-jobs'))
+                add('beanstalkd_other_tubes_deletes', 'gauge',
+                    'Delete commands for jobs in the tubes without labels of their own, as they stand.',
+                    labels, other.get('cmd-delete'))
+
+        add('beanstalktop_collection_duration_seconds', 'gauge',
+            'Time taken by the last collection.', (), round(duration, 6))
+        add('beanstalktop_last_collection_timestamp_seconds', 'gauge',
+            'When the last collection finished.', (), round(time.time(), 3))
+
+        out = []
+        for samples in families.values():
+            out.extend(samples)
+        out.append('# EOF')
+        return '\n'.join(out) + '\n'
+
+
+    def _capped_tubes(self, label, lines):
+        """
+        The (name, line) of each of the host's tubes with labels of its
+        own, and the sum of the rest, or None if there are none.
+        """
+        labelled = self._labelled.setdefault(label, {})
+        listed = set(line['name'] for line in lines)
+        for name in [name for name in labelled if name not in listed]:
+            del labelled[name]
+
+        free = self.max_tubes - len(labelled)
+        if free > 0 and len(labelled) < len(lines):
+            candidates = [line for line in lines if line['name'] not in labelled]
+            if len(candidates) > free:
+                # A fresh TubeIds numbers the tubes in listing order, so
+                # the ids the index hands back are positions in
+                # `candidates`.
+                index = SortedIndex('current-jobs-ready', True)
+                index.update(TubeTable.from_lines(candidates, TubeIds()))
+                candidates = [candidates[tube_id] for tube_id in index.head(free)]
+            for line in candidates:
+                labelled[line['name']] = None
+
+        tubes, other = [], None
+        for line in lines:
+            if line['name'] in labelled:
+                tubes.append((line['name'], line))
+                continue
+            if other is None:
+                other = {}
+            for key, value in line.items():
+                if isinstance(value, (int, float)):
+                    other[key] = other.get(key, 0) + value
+        return tubes, other
+
+
+
+def metrics_request_handler():
+    """
+    The request handler class for --serve-metrics, made when needed so
+    that no other mode waits for http.server to import.
+    """
+    import http.server
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = self.server.exporter.body
+            self.send_response(200)
+            self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsRequestHandler
+
+
+def dict_delta(old, new):
+    """
+    The keys of `new` whose values differ from `old`, and the keys of
+    `old` that `new` no longer has.
+    """
+    changed = dict((key, value) for key, value in new.items()
+                   if key not in old or old[key] != value)
+    return changed, [key for key in old if key not in new]
+
+
+def apply_dict_delta(target, delta):
+    changed, removed = delta
+    target.update(changed)
+    for key in removed:
+        target.pop(key, None)
+
+
+def state_delta(previous, current):
+    """
+    What changed between two (overview, rows by name) states, in the
+    form apply_state_delta() takes.
+    """
+    previous_overview, previous_rows = previous
+    overview, rows = current
+    changed = {}
+    for name, row in rows.items():
+        delta = dict_delta(previous_rows.get(name, {}), row)
+        if delta[0] or delta[1]:
+            changed[name] = delta
+    return {
+        'overview': dict_delta(previous_overview, overview),
+        'rows': changed,
+        'removed': [name for name in previous_rows if name not in rows],
+        }
+
+
+def apply_state_delta(overview, rows, message):
+    apply_dict_delta(overview, message['overview'])
+    for name, delta in message['rows'].items():
+        apply_dict_delta(rows.setdefault(name, {}), delta)
+    for name in message['removed']:
+        rows.pop(name, None)
+
+
+
+class RelayPublisher(object):
+    """
+    Collects on behalf of any number of `--relay` subscribers and hands
+    them each tick as a line of JSON. Every tick is encoded once, both
+    in full and as a delta against the previous tick; a subscriber gets
+    the delta when it is exactly one tick behind and the full snapshot
+    otherwise (on connect, or after falling behind).
+    """
 
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self._ready = threading.Condition()
+        self._seq = 0
+        self._full = None
+        self._delta = None
+        self._previous = None
+        self.closed = False
 
-class BeanstalkTopUI(object):
 
-    def __init__(self, win, options):
-        self.win = win
+    def collect(self):
+        overview, lines = self.monitor.get_data()
+        status = self.monitor.format_status()
+        current = (dict(overview), dict((line['name'], dict(line)) for line in lines))
+
+        with self._ready:
+            seq = self._seq + 1
+            self._full = self._encode({
+                'type': 'full',
+                'seq': seq,
+                'status': status,
+                'overview': current[0],
+                'rows': current[1],
+                })
+            self._delta = None
+            if self._previous is not None:
+                message = state_delta(self._previous, current)
+                message.update(type='delta', seq=seq, status=status)
+                self._delta = self._encode(message)
+            self._previous = current
+            self._seq = seq
+            self._ready.notify_all()
+
+        return overview, lines
+
+
+    def _encode(self, message):
+        return (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+    def next_message(self, last_seq):
+        """
+        Block until there is a tick newer than `last_seq`, then return
+        its number and the message to send for it.
+        """
+        with self._ready:
+            while self._seq <= last_seq and not self.closed:
+                self._ready.wait(1.0)
+            if self._seq == last_seq + 1 and self._delta is not None:
+                return self._seq, self._delta
+            return self._seq, self._full
+
+
+    def close(self):
+        with self._ready:
+            self.closed = True
+            self._ready.notify_all()
+
+
+
+class RelayRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        publisher = self.server.publisher
+        seq = 0
+        while not publisher.closed:
+            seq, message = publisher.next_message(seq)
+            if message is None:
+                continue
+            try:
+                self.wfile.write(message)
+                self.wfile.flush()
+            except OSError:
+                return
+
+
+
+class RelaySubscriber(object):
+    """
+    Stands in for BeanstalkMonitor in a client started with --relay:
+    rather than polling beanstalkd, get_data() waits for the next tick
+    from the relay's socket and applies it to the state it holds.
+    """
+
+    def __init__(self, path, options):
+        self.path = path
         self.options = options
-        self.resize()
+        self.default_overview = DEFAULT_OVERVIEW
+        self.default_row = DEFAULT_ROW
+
+        self._file = None
+        self._seq = None
+        self._overview = {}
+        self._rows = {}
+        self._status = 'connecting to relay'
+        self.tube_filter = options.tube_filter
+        self._reconnect_attempts = 0
+        self._reconnect_at = 0
+
+
+    def format_status(self):
+        return self._status
+
+
+    def get_data(self):
         try:
-            curses.use_default_colors()
-            curses.start_color()
-            curses.curs_set(0)
-        except curses.error:
-            pass
+            if self._file is None:
+                self._connect()
+            line = self._file.readline()
+            if not line:
+                raise EOFError('relay closed the connection')
+            self._apply(json.loads(line.decode('utf-8')))
+            return self._overview, filter_lines(self.tube_filter, list(self._rows.values()))
+        except (OSError, EOFError, ValueError, KeyError):
+            self._disconnect()
+            return self.default_overview, [self.default_row]
 
-        self._connection = None
 
-        self.default_overview = dict(
-            (i, '-') for i in (
-                'pid',
-                'total-jobs',
-                'current-connections',
-                'current-producers',
-                'current-workers',
-                'current-tubes',
-                'current-jobs-ready',
-                'current-jobs-urgent',
-                'current-jobs-buried',
-                'current-jobs-reserved'
-                ))
-
-        self.default_row = dict(
-            (i, '-') for i in (
-                'current-jobs-buried',
-                'current-jobs-delayed',
-                'current-jobs-ready',
-                'current-jobs-reserved',
-                'current-jobs-urgent'
-                ))
-
-        self.default_row.update({'name': 'default'})
+    def set_tube_filter(self, tube_filter):
+        self.tube_filter = tube_filter
 
 
-    def _get_connection(self):
-        return beanstalkc.Connection(host=self.options.host, port=int(self.options.port))
-        if not self._connection:
-            try:
-                self._connection = beanstalkc.Connection(host=self.options.host, port=int(self.options.port))
-            except beanstalkc.SocketError:
-                self.win.erase()
-                raise SystemExit('Host {0} not contactable on port {1}'.format(
-                    self.options.host,
-                    self.options.port
-                    ))
-        return self._connection
+    def _connect(self):
+        delay = self._reconnect_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # A relay ticks every --delay seconds; give it a few of those
+        # before deciding it has gone away.
+        # An --adaptive relay may wait up to --max-delay.
+        sock.settimeout(max(self.options.timeout,
+                            5 * max(self.options.delay_seconds, self.options.max_delay)))
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self._file = sock.makefile('rb')
+        self._sock = sock
+        self._reconnect_attempts = 0
 
-    connection = property(_get_connection)
 
+    def _disconnect(self):
+        if self._file is not None:
+            self._file.close()
+            self._sock.close()
+            self._file = None
+        self._seq = None
+        self._reconnect_at = reconnect_deadline(self._reconnect_attempts)
+        self._reconnect_attempts += 1
+        self._status = 'relay {0} unreachable (retry {1})'.format(
+            self.path, self._reconnect_attempts)
 
-    def _format_uptime(self, seconds):
-        hours, remainder = divmod(seconds, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        return '{0}h {1}m {2}s'.format(hours, minutes, seconds)
 
+    def _apply(self, message):
+        if message['type'] == 'full':
+            self._overview = message['overview']
+            self._rows = message['rows']
+        elif self._seq is not None and message['seq'] == self._seq + 1:
+            apply_state_delta(self._overview, self._rows, message)
+        else:
+            raise ValueError('relay delta out of sequence')
+        self._seq = message['seq']
+        self._status = message['status'] + ' (via relay)'
 
-    def run(self):
-        poll = select.poll()
-        poll.register(sys.stdin.fileno(), select.POLLIN | select.POLLPRI)
-        while 1:
-            self.resize()
-            self.refresh_display()
 
-            try:
-                events = poll.poll(self.options.delay_seconds * 1000.0)
-            except select.error as e:
-                if e.args and e.args[0] == errno.EINTR:
-                    events = 0
-                else:
-                    raise
-            except KeyboardInterrupt:
-                break
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._sock.close()
+            self._file = None
 
-            if events:
-                key = self.win.getch()
-                self.handle_key(key)
 
 
-    def handle_key(self, key):
-        key_bindings = {
-            ord('q'): lambda: sys.exit(0),
-            ord('Q'): lambda: sys.exit(0),
-            }
+def run_relay_server(options):
+    path = options.relay_serve
+    if os.path.exists(path):
+        # Only replace a socket nothing is listening on any more.
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise SystemExit('A relay is already listening on {0}'.format(path))
+        finally:
+            probe.close()
 
-        action = key_bindings.get(key, lambda: None)
-        action()
+    monitor = BeanstalkMonitor(options)
+    publisher = RelayPublisher(monitor)
+    collector = BackgroundCollector(
+        publisher.collect, options.delay_seconds, interval=make_interval(options))
 
+    server = socketserver.ThreadingUnixStreamServer(path, RelayRequestHandler)
+    server.daemon_threads = True
+    server.publisher = publisher
+    # Make sure the socket file is cleaned up when we are told to stop.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    collector.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
+        server.server_close()
+        os.unlink(path)
+        collector.stop()
+        if not collector.is_alive():
+            monitor.close()
 
-    def resize(self):
-        self.height, self.width = self.win.getmaxyx()
 
+class SessionRecorder(object):
+    """
+    Appends every tick to `path` as a zlib-compressed frame: a key frame
+    with the whole state every `key_interval` ticks, and in between only
+    what changed since the tick before. The offset of each key frame is
+    appended to `path`.idx so a replay can seek without reading the
+    frames in front of it.
+    """
+
+    def __init__(self, path, key_interval=RECORD_KEY_INTERVAL):
+        self.path = path
+        self.key_interval = key_interval
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(RECORD_MAGIC)
+        self._index = open(path + '.idx', 'ab')
+        self._previous = None
+        self._count = 0
+
+
+    def write(self, timestamp, overview, lines, status):
+        current = (dict(overview), dict((line['name'], dict(line)) for line in lines))
+        if self._previous is None or self._count % self.key_interval == 0:
+            kind = RECORD_KEY
+            message = {'overview': current[0], 'rows': current[1]}
+        else:
+            kind = RECORD_DELTA
+            message = state_delta(self._previous, current)
+        message['status'] = status
+
+        payload = zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+        offset = self._file.tell()
+        self._file.write(RECORD_FRAME.pack(len(payload), kind, timestamp) + payload)
+        self._file.flush()
+        # The index is written after the frame it points at, so a crash
+        # can lose an index entry but never leave one pointing past the
+        # end of the file.
+        if kind == RECORD_KEY:
+            self._index.write(RECORD_INDEX_ENTRY.pack(timestamp, offset))
+            self._index.flush()
+
+        self._previous = current
+        self._count += 1
+
+
+    def close(self):
+        self._file.close()
+        self._index.close()
 
-    def refresh_display(self):
-        self.win.erase()
 
-        titles = (
-            'TUBE',
-            'READY',
-            'URGENT',
-            'RESRVD',
-            'DELAYD',
-            'BURIED',
-            )
 
-        overview, lines = self.get_data()
+class Recording(object):
+    """
+    A file written by SessionRecorder, mapped rather than read so that
+    opening and seeking a long recording costs no more than a short one.
+    If the index is missing it is rebuilt from the frame headers.
+    """
 
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
         try:
-            overview['uptime'] = self._format_uptime(overview.get('uptime', 0))
-        except:
-            overview['uptime'] = self._format_uptime(0)
-
-        summary_items = [item.format(**overview) for item in (
-            'PID: {pid}',
-            'Uptime: {uptime}',
-            'Total Jobs: {total-jobs}',
-            'Connections: {current-connections} ({current-producers}:{current-workers})',
-            'Cur. Tubes: {current-tubes}',
-            'Cur. Ready: {current-jobs-ready}',
-            'Cur. Urgent: {current-jobs-urgent}',
-            'Cur. Buried: {current-jobs-buried}',
-            'Cur. Reserved: {current-jobs-reserved}',
-            )]
-
-        summary_lines = [
-            summary_items[0:3],
-            summary_items[3:6],
-            summary_items[6:],
-            ]
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._data = b''
+        if self._data[:len(RECORD_MAGIC)] != RECORD_MAGIC:
+            self._file.close()
+            raise ValueError('{0} is not a beanstalktop recording'.format(path))
 
-        summarywidth = self.width // max(len(i) for i in summary_lines)
+        self._index = self._load_index(path + '.idx')
+        self._index_size = len(self._index) // RECORD_INDEX_ENTRY.size
+        if not self._index_size:
+            raise ValueError('{0} has no frames'.format(path))
+
+        self.start = RECORD_INDEX_ENTRY.unpack_from(self._index, 0)[0]
+        self.end = self.start
+        for timestamp, _, _ in self.frames(self.key_frame_before(float('inf'))):
+            self.end = max(self.end, timestamp)
 
-        for item in summary_lines:
-            line = ''.join(s.ljust(summarywidth) for s in item)
-            self.win.addstr(line.ljust(self.width))
 
-        self.win.addstr(' ' * self.width)
+    def _load_index(self, path):
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                size -= size % RECORD_INDEX_ENTRY.size
+                if size:
+                    return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        except OSError:
+            pass
 
-        colwidth = self.width // len(titles) + 1
+        index = bytearray()
+        offset = len(RECORD_MAGIC)
+        while offset + RECORD_FRAME.size <= len(self._data):
+            length, kind, timestamp = RECORD_FRAME.unpack_from(self._data, offset)
+            if kind == RECORD_KEY:
+                index += RECORD_INDEX_ENTRY.pack(timestamp, offset)
+            offset += RECORD_FRAME.size + length
+        return bytes(index)
 
-        titlelen = 0
-        for i in range(len(titles)):
-            attr = curses.A_REVERSE
 
-            if i is 0:
-                title = (' ' + titles[i]).ljust(colwidth - 1)
+    def key_frame_before(self, timestamp):
+        """
+        The offset of the last key frame recorded at or before
+        `timestamp`, or of the first one if there is none.
+        """
+        low, high = 0, self._index_size
+        while low < high:
+            middle = (low + high) // 2
+            if RECORD_INDEX_ENTRY.unpack_from(self._index, middle * RECORD_INDEX_ENTRY.size)[0] <= timestamp:
+                low = middle + 1
             else:
-                title = (titles[i] + ' ').rjust(colwidth - 1)
+                high = middle
+        return RECORD_INDEX_ENTRY.unpack_from(
+            self._index, max(0, low - 1) * RECORD_INDEX_ENTRY.size)[1]
 
-            titlelen += len(title)
-            self.win.addstr(title, attr)
 
-        self.win.addstr(' ' * (self.width - titlelen), curses.A_REVERSE)
+    def frames(self, offset):
+        """
+        Yield (timestamp, kind, payload) for each frame from `offset`
+        on. A frame cut short by a crash ends the recording.
+        """
+        data = self._data
+        while offset + RECORD_FRAME.size <= len(data):
+            length, kind, timestamp = RECORD_FRAME.unpack_from(data, offset)
+            offset += RECORD_FRAME.size
+            if offset + length > len(data):
+                break
+            yield timestamp, kind, data[offset:offset + length]
+            offset += length
 
-        columns = (
-            'name',
-            'current-jobs-ready',
-            'current-jobs-urgent',
-            'current-jobs-reserved',
-            'current-jobs-delayed',
-            'current-jobs-buried',
-            )
 
-        max_lines = self.height - (len(summary_lines) + 1)
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        if isinstance(self._index, mmap.mmap):
+            self._index.close()
+        self._file.close()
 
-        sortedlines = sorted(lines, key=lambda x: x['current-jobs-ready'])[::-1]
 
-        for i in range(max_lines):
-            try:
-                line = sortedlines[i]
-            except IndexError:
+
+class ReplayCollector(threading.Thread):
+    """
+    Plays a Recording back in place of both the monitor and the
+    BackgroundCollector: frames are published as Snapshots at the pace
+    they were recorded, scaled by `speed`, and playback can be paused
+    or moved with seek(), which starts from the nearest key frame.
+    """
+
+    live = False
+    cached = False
+    error = None
+
+    def __init__(self, recording, history, tube_filter, wakeup_fd=None):
+        super(ReplayCollector, self).__init__(name='beanstalktop-replay')
+        self.daemon = True
+        self.recording = recording
+        self.history = history
+        self.tube_filter = tube_filter
+        self.wakeup_fd = wakeup_fd
+        self.default_overview = DEFAULT_OVERVIEW
+        self.default_row = DEFAULT_ROW
+        self.snapshot = None
+        self.speed = 1.0
+        self.paused = False
+        self.position = recording.start
+
+        self._tube_ids = TubeIds()
+        self._overview = {}
+        self._rows = {}
+        self._status = ''
+        self._frames = None
+        self._pending = None
+        self._seek_to = recording.start
+        self._refilter = False
+        self._changed = threading.Event()
+        self._stopped = False
+
+
+    def clock(self):
+        return self.position
+
+
+    def format_status(self):
+        return '{0}, replay {1} {2}'.format(
+            self._status,
+            time.strftime('%H:%M:%S', time.localtime(self.position)),
+            'paused' if self.paused else 'x{0:g}'.format(self.speed))
+
+
+    def toggle_pause(self):
+        if self.paused and self._pending is None and self.position >= self.recording.end:
+            self._seek_to = self.recording.start
+        self.paused = not self.paused
+        self._changed.set()
+
+
+    def change_speed(self, factor):
+        self.speed = min(REPLAY_MAX_SPEED, max(1.0 / REPLAY_MAX_SPEED, self.speed * factor))
+        self._changed.set()
+
+
+    def set_tube_filter(self, tube_filter):
+        self.tube_filter = tube_filter
+        self._refilter = True
+        self._changed.set()
+
+
+    def seek(self, offset):
+        self._seek_to = min(self.recording.end, max(self.recording.start, self.position + offset))
+        self._changed.set()
+
+
+    def run(self):
+        while not self._stopped:
+            self._changed.clear()
+
+            if self._seek_to is not None:
+                target, self._seek_to = self._seek_to, None
+                self._seek(target)
+                self._publish()
+                continue
+
+            if self._refilter:
+                self._refilter = False
+                self._publish(record=False)
+                continue
+
+            if self.paused:
+                self._changed.wait()
+                continue
+
+            if self._pending is None:
+                self._pending = next(self._frames, None)
+                if self._pending is None:
+                    self.paused = True
+                    self._publish()
+                    continue
+
+            timestamp, kind, payload = self._pending
+            # Don't sit out the gap between two recorded sessions.
+            wait = min(REPLAY_MAX_WAIT, (timestamp - self.position) / self.speed)
+            speed, started = self.speed, time.monotonic()
+            if wait > 0 and self._changed.wait(wait):
+                self.position = min(timestamp, self.position + (time.monotonic() - started) * speed)
+                continue
+
+            self._pending = None
+            self._apply(kind, payload)
+            self.position = timestamp
+            self._publish()
+
+
+    def _seek(self, target):
+        self._frames = self.recording.frames(self.recording.key_frame_before(target))
+        self._pending = None
+        self.history.clear()
+        position = None
+        for frame in self._frames:
+            if position is not None and frame[0] > target:
+                self._pending = frame
                 break
-            row = ''
-            for c, column in enumerate(columns):
-                try:
-                    if c is 0:
-                        row += (' ' + str(line[column])).ljust(colwidth - 1)
-                    else:
-                        row += (str(line[column]) + ' ').rjust(colwidth - 1)
+            self._apply(frame[1], frame[2])
+            position = frame[0]
+        self.position = target if position is None else max(target, position)
 
-                except curses.error:
-                    pass
-            try:
-                self.win.addstr(row.ljust(self.width))
-            except curses.error:
-                pass
 
+    def _apply(self, kind, payload):
+        message = json.loads(zlib.decompress(payload).decode('utf-8'))
+        if kind == RECORD_KEY:
+            self._overview = message['overview']
+            self._rows = message['rows']
+        else:
+            apply_state_delta(self._overview, self._rows, message)
+        self._status = message['status']
 
-        self.win.refresh()
 
+    def _publish(self, record=True):
+        lines = filter_lines(self.tube_filter, list(self._rows.values()))
+        if record:
+            self.history.record(lines, self.position)
+        self.snapshot = freeze_snapshot(self._overview, lines, time.monotonic(), self._tube_ids)
+        self._tube_ids = self.snapshot.table.tube_ids
+        wake(self.wakeup_fd)
 
-    def get_data(self):
-        """
-        Main statistics
-        {
-        'binlog-current-index': 0,
-        'binlog-max-size': 10485760,
-        'binlog-oldest-index': 0,
-        'binlog-records-migrated': 0,
-        'binlog-records-written': 0,
-        'cmd-bury': 580,
-        'cmd-delete': 15291,
-        'cmd-ignore': 3,
-        'cmd-kick': 0,
-        'cmd-list-tube-used': 0,
-        'cmd-list-tubes': 1,
-        'cmd-list-tubes-watched': 0,
-        'cmd-pause-tube': 0,
-        'cmd-peek': 0,
-        'cmd-peek-buried': 0,
-        'cmd-peek-delayed': 0,
-        'cmd-peek-ready': 0,
-        'cmd-put': 19623,
-        'cmd-release': 0,
-        'cmd-reserve': 0,
-        'cmd-reserve-with-timeout': 15873,
-        'cmd-stats': 1,
-        'cmd-stats-job': 22719,
-        'cmd-stats-tube': 0,
-        'cmd-touch': 0,
-        'cmd-use': 10603,
-        'cmd-watch': 5,
-        'current-connections': 8,
-        'current-jobs-buried': 580,
-        'current-jobs-delayed': 0,
-        'current-jobs-ready': 3750,
-        'current-jobs-reserved': 2,
-        'current-jobs-urgent': 0,
-        'current-producers': 3,
-        'current-tubes': 8,
-        'current-waiting': 0,
-        'current-workers': 3,
-        'job-timeouts': 0,
-        'max-job-size': 65535,
-        'pid': 78938,
-        'rusage-stime': 2.585616,
-        'rusage-utime': 1.005601,
-        'total-connections': 8,
-        'total-jobs': 19623,
-        'uptime': 156,
-        'version': 1.6,
-        }
 
-        Tube-specific statistics
-        {
-        'cmd-delete': 892,
-        'cmd-pause-tube': 0,
-        'current-jobs-buried': 685,
-        'current-jobs-delayed': 0,
-        'current-jobs-ready': 1001,
-        'current-jobs-reserved': 1,
-        'current-jobs-urgent': 0
-        'current-using': 0,
-        'current-waiting': 0,
-        'current-watching': 1,
-        'name': 'default',
-        'pause': 0,
-        'pause-time-left': 0,
-        'total-jobs': 2579,
-        }
-        """
-        try:
-            return self.connection.stats(), [self.connection.stats_tube(tube) for tube in self.connection.tubes()]
-        except (TypeError, beanstalkc.SocketError, beanstalkc.CommandFailed):
-            return self.default_overview, [self.default_row]
+    def stop(self, timeout=0.5):
+        self._stopped = True
+        self._changed.set()
+        if self.is_alive():
+            self.join(timeout)
 
 
+    def close(self):
+        self.recording.close()
 
-def run_beanstalktop_window(win, options):
-    ui = BeanstalkTopUI(win, options)
-    ui.run()
 
 
-def run_beanstalktop(options):
-    return curses.wrapper(run_beanstalktop_window, options)
+def make_source(options):
+    if options.relay:
+        return RelaySubscriber(options.relay, options)
+    return BeanstalkMonitor(options)
 
 
-def main():
+def run_metrics_server(options):
+    address, _, port = options.serve_metrics.rpartition(':')
+    monitor = BeanstalkMonitor(options)
+    exporter = MetricsExporter(monitor, options.metrics_max_tubes)
+    collector = BackgroundCollector(
+        exporter.collect, options.delay_seconds, interval=make_interval(options))
+
+    import http.server
+    server = http.server.ThreadingHTTPServer((address or '0.0.0.0', int(port)), metrics_request_handler())
+    server.daemon_threads = True
+    server.exporter = exporter
+    collector.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        collector.stop()
+        if not collector.is_alive():
+            monitor.close()
+
+
+def run_batch(options, stream=None):
+    """
+    Collect and print one record per tick without curses, like
+    `top -b`. Each record is written in a single call, so a slow reader
+    holds the loop up rather than letting output queue in memory, and
+    ticks missed while blocked are skipped rather than made up.
+    """
+    stream = stream or sys.stdout
+    monitor = make_source(options)
+    recorder = SessionRecorder(options.record) if options.record else None
+    index = SortedIndex('current-jobs-ready', True)
+    alerts = AlertEngine(options.alert_rules)
+    actions = AlertActions(options.alert_command, options.alert_fifo)
+    tube_ids = TubeIds()
+    delay = 0 if options.relay else options.delay_seconds
+    interval = None if options.relay else make_interval(options)
+    iteration = 0
+    next_tick = time.monotonic()
+
+    try:
+        while True:
+            started = time.monotonic()
+            overview, lines = monitor.get_data()
+            if interval is not None:
+                delay = interval.next(overview, time.monotonic() - started)
+            overview = dict(overview, status=monitor.format_status())
+            timestamp = time.time()
+            if recorder is not None:
+                recorder.write(timestamp, overview, lines, overview['status'])
+            if alerts:
+                table = TubeTable.from_lines(lines, tube_ids)
+                tube_ids = table.tube_ids
+                actions(timestamp, alerts.update(overview, table, timestamp))
+
+            if options.format == 'json':
+                record = format_json_record(timestamp, overview, lines)
+            elif options.format == 'csv':
+                record = format_csv_record(timestamp, overview, lines, header=iteration == 0)
+            else:
+                record = format_text_record(timestamp, overview, lines, index)
+
+            stream.write(record)
+            if options.flush:
+                stream.flush()
+
+            iteration += 1
+            if options.iterations and iteration >= options.iterations:
+                break
+
+            now = time.monotonic()
+            next_tick = max(next_tick + delay, now)
+            time.sleep(next_tick - now)
+    except BrokenPipeError:
+        # The reader went away (e.g. `| head`); point stdout at devnull
+        # so the interpreter's final flush doesn't complain as well.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, stream.fileno())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.close()
+        actions.close()
+        if recorder is not None:
+            recorder.close()
+
+
+def make_parser():
     parser = optparse.OptionParser()
     parser.add_option('--host',
                       dest="host",
-                      default="0.0.0.0",
-                      help="beanstalkd host [0.0.0.0]"
+                      action="append",
+                      metavar="HOST[:PORT]",
+                      help="beanstalkd host, may be repeated [0.0.0.0]"
+                      )
+    parser.add_option('--hosts-file',
+                      dest="hosts_file",
+                      metavar="FILE",
+                      help="file listing one beanstalkd HOST[:PORT] per line"
                       )
     parser.add_option('-p', '--port',
                       dest="port",
                       default=11300,
-                      help="beanstalkd port [11300]"
+                      help="default beanstalkd port [11300]"
                       )
     parser.add_option('-d', '--delay',
                       dest="delay_seconds",
-                      default=1,
+                      default=1.0,
+                      type="float",
+                      metavar='NUM',
+                      help="delay between refreshes, may be a fraction [1s]"
+                      )
+    parser.add_option('--adaptive',
+                      dest="adaptive",
+                      default=False,
+                      action="store_true",
+                      help="refresh faster while jobs are moving and slower while idle"
+                      )
+    parser.add_option('--min-delay',
+                      dest="min_delay",
+                      default=0.25,
+                      type="float",
+                      metavar='NUM',
+                      help="shortest delay --adaptive will use [0.25s]"
+                      )
+    parser.add_option('--max-delay',
+                      dest="max_delay",
+                      default=10.0,
+                      type="float",
+                      metavar='NUM',
+                      help="longest delay --adaptive will use [10s]"
+                      )
+    parser.add_option('--max-load',
+                      dest="max_load",
+                      default=0.25,
+                      type="float",
+                      metavar='NUM',
+                      help="largest fraction of the time --adaptive may spend collecting [0.25]"
+                      )
+    parser.add_option('--no-pipeline',
+                      dest="pipeline",
+                      default=True,
+                      action="store_false",
+                      help="send one stats-tube at a time instead of pipelining them"
+                      )
+    parser.add_option('--tube-budget',
+                      dest="tube_budget",
+                      default=0,
+                      type="int",
+                      metavar='NUM',
+                      help="poll at most NUM tubes per host each tick, rotating through the rest [all]"
+                      )
+    parser.add_option('--pyyaml',
+                      dest="pyyaml",
+                      default=False,
+                      action="store_true",
+                      help="parse server replies with PyYAML instead of the built-in parser"
+                      )
+    parser.add_option('-t', '--timeout',
+                      dest="timeout",
+                      default=5.0,
+                      type="float",
+                      metavar='NUM',
+                      help="give up on a server request after this long [5s]"
+                      )
+    parser.add_option('--history',
+                      dest="history",
+                      default=60,
+                      type="int",
+                      metavar='NUM',
+                      help="samples of history kept per tube [60]"
+                      )
+    parser.add_option('--history-expiry',
+                      dest="history_expiry",
+                      default=300.0,
+                      type="float",
+                      metavar='NUM',
+                      help="forget the history of tubes gone for this long [300s]"
+                      )
+    parser.add_option('-b', '--batch',
+                      dest="batch",
+                      default=False,
+                      action="store_true",
+                      help="print records to stdout instead of running the curses UI"
+                      )
+    parser.add_option('--format',
+                      dest="format",
+                      default='text',
+                      type="choice",
+                      choices=BATCH_FORMATS,
+                      help="batch output format: text, json or csv [text]"
+                      )
+    parser.add_option('-n', '--iterations',
+                      dest="iterations",
+                      default=0,
+                      type="int",
+                      metavar='NUM',
+                      help="stop batch mode after this many records [run forever]"
+                      )
+    parser.add_option('--flush',
+                      dest="flush",
+                      default=False,
+                      action="store_true",
+                      help="flush stdout after every batch record"
+                      )
+    parser.add_option('--serve-metrics',
+                      dest="serve_metrics",
+                      metavar="ADDR:PORT",
+                      help="serve OpenMetrics on ADDR:PORT instead of running the UI"
+                      )
+    parser.add_option('--metrics-max-tubes',
+                      dest="metrics_max_tubes",
+                      default=500,
+                      type="int",
                       metavar='NUM',
-                      help="delay between refreshes [1s]"
+                      help="tubes per host exported with their own labels [500]"
+                      )
+    parser.add_option('--relay-serve',
+                      dest="relay_serve",
+                      metavar="PATH",
+                      help="collect once and publish to --relay clients on this unix socket"
+                      )
+    parser.add_option('--relay',
+                      dest="relay",
+                      metavar="PATH",
+                      help="show the data published by a --relay-serve process instead of polling"
+                      )
+    parser.add_option('--include',
+                      dest="include",
+                      action="append",
+                      metavar="PATTERN",
+                      help="only show tubes matching a glob, or re:REGEX; may be repeated"
+                      )
+    parser.add_option('--exclude',
+                      dest="exclude",
+                      action="append",
+                      metavar="PATTERN",
+                      help="hide tubes matching a glob, or re:REGEX; may be repeated"
+                      )
+    parser.add_option('--canary',
+                      dest="canary",
+                      default=False,
+                      action="store_true",
+                      help="put, reserve and delete a probe job every --delay seconds and show the p50/p99/max latency"
+                      )
+    parser.add_option('--profile',
+                      dest="profile",
+                      default=False,
+                      action="store_true",
+                      help="print histograms of collection and render times on exit"
+                      )
+    parser.add_option('--record',
+                      dest="record",
+                      metavar="FILE",
+                      help="append every tick of the display or batch mode to FILE"
+                      )
+    parser.add_option('--replay',
+                      dest="replay",
+                      metavar="FILE",
+                      help="play back a --record FILE (space pauses, +/- change speed, arrows and [ ] seek)"
+                      )
+    parser.add_option('--cache-dir',
+                      dest="cache_dir",
+                      metavar="DIR",
+                      help="where the display keeps each host's last snapshot to start from "
+                           "[$XDG_CACHE_HOME/beanstalktop]"
                       )
+    parser.add_option('--no-cache',
+                      dest="cache",
+                      default=True,
+                      action="store_false",
+                      help="don't start from, or save, cached snapshots"
+                      )
+    parser.add_option('--action-rate',
+                      dest="action_rate",
+                      default=ACTION_RATE,
+                      type="float",
+                      metavar="NUM",
+                      help="jobs a kick (k) or delete (D) of buried jobs from the display "
+                           "moves each second at most [{0:g}]".format(ACTION_RATE)
+                      )
+    parser.add_option('--rules',
+                      dest="rules",
+                      metavar="FILE",
+                      help="alert rules, one 'NAME: [server] FIELD OP VALUE [clear VALUE] [for SECONDS] "
+                           "[cooldown SECONDS]' per line; firing tubes are highlighted"
+                      )
+    parser.add_option('--alert-command',
+                      dest="alert_command",
+                      metavar="CMD",
+                      help="in batch mode, run CMD through the shell for each alert firing or resolving, "
+                           "with the details in BEANSTALKTOP_ALERT_* variables"
+                      )
+    parser.add_option('--alert-fifo',
+                      dest="alert_fifo",
+                      metavar="FILE",
+                      help="in batch mode, write each alert event as a JSON line to the FIFO FILE"
+                      )
+    return parser
+
+
+def main():
+    locale.setlocale(locale.LC_ALL, '')
 
+    parser = make_parser()
     options, args = parser.parse_args()
     if args:
         parser.error('Unexpected arguments: ' + ' '.join(args))
 
-    main_loop = lambda: run_beanstalktop(options)
-    main_loop()
+    try:
+        options.hosts = parse_hosts(options.host, options.hosts_file, options.port)
+    except (IOError, ValueError) as e:
+        parser.error(str(e))
+
+    options.instruments = Instruments()
+    options.snapshot_cache = None
+    if options.cache and not (options.batch or options.serve_metrics or options.relay_serve):
+        options.snapshot_cache = SnapshotCache(options.cache_dir or default_cache_directory())
+
+    try:
+        options.tube_filter = TubeFilter(options.include or (), options.exclude or ())
+    except re.error as e:
+        parser.error('bad tube pattern: {0}'.format(e))
+
+    try:
+        options.alert_rules = parse_alert_rules(options.rules) if options.rules else []
+    except (IOError, ValueError) as e:
+        parser.error(str(e))
+    if (options.alert_command or options.alert_fifo) and not (options.batch and options.rules):
+        parser.error('--alert-command and --alert-fifo need --rules and --batch')
+
+    if options.delay_seconds <= 0 or options.min_delay <= 0:
+        parser.error('delays must be greater than zero')
+    if options.min_delay > options.max_delay:
+        parser.error('--min-delay must not be greater than --max-delay')
+    if not 0 < options.max_load <= 1:
+        parser.error('--max-load must be between 0 and 1')
+    if options.action_rate <= 0:
+        parser.error('--action-rate must be greater than zero')
+    if options.history < 1:
+        parser.error('--history must be at least 1')
+    if options.history_expiry <= 0:
+        parser.error('--history-expiry must be greater than zero')
+
+    if options.serve_metrics and not options.serve_metrics.rpartition(':')[2].isdigit():
+        parser.error('--serve-metrics expects ADDR:PORT')
+
+    if (options.record or options.replay) and (options.serve_metrics or options.relay_serve):
+        parser.error('--record and --replay only work with the display or batch mode')
+    if options.replay and (options.batch or options.record or options.relay):
+        parser.error('--replay only works with the interactive display')
+    if options.replay:
+        try:
+            Recording(options.replay).close()
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+
+    if options.relay_serve:
+        main_loop = lambda: run_relay_server(options)
+    elif options.serve_metrics:
+        main_loop = lambda: run_metrics_server(options)
+    elif options.batch:
+        main_loop = lambda: run_batch(options)
+    else:
+        main_loop = lambda: run_beanstalktop(options)
+    try:
+        main_loop()
+    finally:
+        if options.profile:
+            sys.stderr.write(options.instruments.format_histograms())
 
 
 if __name__ == '__main__':
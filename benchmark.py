@@ -0,0 +1,477 @@
+#!/bin/python
+"""
+Measure beanstalktop's refresh path against an in-process fake
+beanstalkd:
+
+    python benchmark.py [--tubes 10,1000,10000] [--latency S] [--jitter S]
+
+For each tube count it reports the time one get_data() takes, the time
+spent parsing the stats-tube replies, the time the job view takes to
+look at a tube, the time refresh_display() takes, the time and peak
+memory per tube of a whole tick -- collecting, publishing and drawing
+-- and the memory held per tube. The peak includes the dict each
+stats-tube reply is parsed into; only rate state and snapshots are held
+as columns between ticks.
+
+Drawing is measured on a real curses screen: a child process runs those
+measurements on a pseudo-terminal, whose output this one reads and
+throws away.
+"""
+
+import curses
+import fcntl
+import gc
+import json
+import optparse
+import os
+import pty
+import random
+import socketserver
+import statistics
+import struct
+import termios
+import threading
+import time
+import traceback
+import tracemalloc
+import beanstalktop
+
+
+SCREEN_HEIGHT = 50
+SCREEN_WIDTH = 160
+
+# Each tube holds a ready, a delayed and a buried job, numbered in that
+# order from 1 up.
+JOB_STATES = ('ready', 'delayed', 'buried')
+
+
+
+class FakeBeanstalkd(object):
+    """
+    Just enough of beanstalkd for beanstalktop: stats, list-tubes,
+    stats-tube, use, the peek commands and stats-job, over `tubes` tubes
+    that each hold one job in each of JOB_STATES. Every reply is held
+    back by `latency` plus up to `jitter` seconds, and each stats call
+    moves the counters on so that rates have something to show.
+    """
+
+    def __init__(self, tubes, latency=0.0, jitter=0.0):
+        self.tubes = ['default'] + ['tube{0}'.format(i) for i in range(tubes - 1)]
+        self.latency = latency
+        self.jitter = jitter
+        self.puts = 0
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeBeanstalkdHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-beanstalkd')
+        self._thread.daemon = True
+
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+
+    def start(self):
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+
+    def stats(self):
+        self.puts += len(self.tubes)
+        return {
+            'pid': 1,
+            'version': '"1.12"',
+            'uptime': 100,
+            'total-jobs': self.puts,
+            'cmd-put': self.puts,
+            'cmd-delete': self.puts - len(self.tubes),
+            'cmd-bury': 0,
+            'current-tubes': len(self.tubes),
+            'current-connections': 1,
+            'current-producers': 0,
+            'current-workers': 0,
+            'current-jobs-ready': len(self.tubes),
+            'current-jobs-urgent': 0,
+            'current-jobs-reserved': 0,
+            'current-jobs-delayed': 0,
+            'current-jobs-buried': 0,
+            }
+
+
+    def stats_tube(self, index):
+        return {
+            'name': self.tubes[index],
+            'current-jobs-urgent': 0,
+            'current-jobs-ready': index % 17,
+            'current-jobs-reserved': index % 3,
+            'current-jobs-delayed': 0,
+            'current-jobs-buried': index % 2,
+            'total-jobs': self.puts + index,
+            'current-using': 1,
+            'current-watching': 1,
+            'current-waiting': 0,
+            'cmd-delete': self.puts,
+            'cmd-pause-tube': 0,
+            'pause': 0,
+            'pause-time-left': 0,
+            }
+
+
+    def job(self, jid):
+        """
+        The (tube index, state) of job `jid`, or None if there is none.
+        """
+        if not 0 < jid <= len(self.tubes) * len(JOB_STATES):
+            return None
+        index, state = divmod(jid - 1, len(JOB_STATES))
+        return index, JOB_STATES[state]
+
+
+    def job_id(self, index, state):
+        return index * len(JOB_STATES) + JOB_STATES.index(state) + 1
+
+
+    def stats_job(self, jid):
+        index, state = self.job(jid)
+        return {
+            'id': jid,
+            'tube': self.tubes[index],
+            'state': state,
+            'pri': 1024,
+            'age': 60 + index,
+            'delay': 30 if state == 'delayed' else 0,
+            'ttr': 60,
+            'time-left': 30 if state == 'delayed' else 0,
+            'file': 0,
+            'reserves': 1 if state == 'buried' else 0,
+            'timeouts': 0,
+            'releases': 0,
+            'buries': 1 if state == 'buried' else 0,
+            'kicks': 0,
+            }
+
+
+
+def yaml_body(data):
+    return '---\n' + ''.join('{0}: {1}\n'.format(key, value) for key, value in data.items())
+
+
+def yaml_list_body(items):
+    return '---\n' + ''.join('- {0}\n'.format(item) for item in items)
+
+
+
+class FakeBeanstalkdHandler(socketserver.StreamRequestHandler):
+
+    # Replies go out one write each; don't let Nagle hold them back
+    # waiting for the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        fake = self.server.fake
+        index = dict((name, i) for i, name in enumerate(fake.tubes))
+        using = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii').split()
+            if not command or command[0] == 'quit':
+                return
+            fake.delay()
+
+            name, args = command[0], command[1:]
+            if name == 'stats':
+                reply = self._ok(yaml_body(fake.stats()))
+            elif name == 'list-tubes':
+                reply = self._ok(yaml_list_body(fake.tubes))
+            elif name == 'stats-tube' and args and args[0] in index:
+                reply = self._ok(yaml_body(fake.stats_tube(index[args[0]])))
+            elif name == 'use' and args:
+                using = index.get(args[0], 0)
+                reply = 'USING {0}\r\n'.format(args[0]).encode('ascii')
+            elif name in ('peek-ready', 'peek-delayed', 'peek-buried'):
+                reply = self._found(fake, fake.job_id(using, name[5:]))
+            elif name in ('peek', 'stats-job') and args and args[0].isdigit() and fake.job(int(args[0])):
+                jid = int(args[0])
+                reply = self._found(fake, jid) if name == 'peek' else self._ok(yaml_body(fake.stats_job(jid)))
+            elif name in ('stats-tube', 'peek', 'stats-job'):
+                reply = b'NOT_FOUND\r\n'
+            else:
+                reply = b'UNKNOWN_COMMAND\r\n'
+            self.wfile.write(reply)
+
+
+    def _ok(self, body):
+        body = body.encode('ascii')
+        return b'OK ' + str(len(body)).encode('ascii') + b'\r\n' + body + b'\r\n'
+
+
+    def _found(self, fake, jid):
+        index, state = fake.job(jid)
+        body = '{0} job in {1}'.format(state, fake.tubes[index]).encode('ascii')
+        return b'FOUND ' + str(jid).encode('ascii') + b' ' + \
+            str(len(body)).encode('ascii') + b'\r\n' + body + b'\r\n'
+
+
+
+def median_time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def on_terminal(function, *args):
+    """
+    function(window, *args) run in a child process whose curses screen
+    is a SCREEN_HEIGHT by SCREEN_WIDTH pseudo-terminal, so that drawing
+    goes through curses and out to a terminal as it does for real. The
+    result comes back as JSON.
+    """
+    results, write_end = os.pipe()
+    pid, terminal = pty.fork()
+    if pid == 0:
+        os.close(results)
+        status = 1
+        try:
+            fcntl.ioctl(0, termios.TIOCSWINSZ, struct.pack('HHHH', SCREEN_HEIGHT, SCREEN_WIDTH, 0, 0))
+            os.environ['TERM'] = 'xterm'
+            payload = json.dumps(curses.wrapper(function, *args))
+            status = 0
+        except BaseException:
+            payload = json.dumps(traceback.format_exc())
+        with os.fdopen(write_end, 'w') as f:
+            f.write(payload)
+        os._exit(status)
+
+    os.close(write_end)
+    # Keep the terminal drained, or the child blocks drawing.
+    while True:
+        try:
+            if not os.read(terminal, 65536):
+                break
+        except OSError:
+            # EIO once the child has gone.
+            break
+    os.close(terminal)
+    _, status = os.waitpid(pid, 0)
+    with os.fdopen(results) as f:
+        payload = json.loads(f.read())
+    if status != 0:
+        raise RuntimeError('measuring on a terminal failed:\n' + payload)
+    return payload
+
+
+def make_options(address, args=()):
+    options, _ = beanstalktop.make_parser().parse_args(list(args))
+    options.hosts = [address]
+    options.tube_filter = beanstalktop.TubeFilter()
+    options.instruments = beanstalktop.Instruments()
+    options.alert_rules = []
+    options.snapshot_cache = None
+    return options
+
+
+def bench_collect(options, repeat):
+    monitor = beanstalktop.BeanstalkMonitor(options)
+    try:
+        monitor.get_data()
+        return median_time(monitor.get_data, repeat)
+    finally:
+        monitor.close()
+
+
+def bench_parse(fake, repeat):
+    bodies = [yaml_body(fake.stats_tube(i)) for i in range(len(fake.tubes))]
+    return median_time(lambda: [beanstalktop.parse_yaml(b) for b in bodies], repeat)
+
+
+def bench_inspect(options, repeat, tube='default'):
+    """
+    The median time the job view takes to look at a tube's next ready,
+    delayed and buried jobs with none of their stats cached.
+    """
+    host, port = options.hosts[0]
+    inspector = beanstalktop.JobInspector(options, beanstalktop.JobStatsCache())
+
+    def look():
+        inspector.cache = beanstalktop.JobStatsCache()
+        if len(inspector._look(host, port, tube)) != len(JOB_STATES):
+            raise RuntimeError('the job view found the wrong jobs')
+
+    try:
+        look()
+        return median_time(look, repeat)
+    finally:
+        inspector._close_connection()
+
+
+def bench_render(window, options, repeat):
+    ui = beanstalktop.BeanstalkTopUI(window, options)
+    try:
+        ticks = [ui.monitor.get_data() for _ in range(2)]
+        tube_ids = beanstalktop.TubeIds()
+        snapshots = [beanstalktop.freeze_snapshot(overview, lines, time.monotonic(), tube_ids)
+                     for overview, lines in ticks]
+        frames = iter(range(repeat * 2 + 1))
+
+        def render():
+            # Alternate between two ticks so every frame has changes to
+            # index and draw, as it would when running.
+            ui.collector.snapshot = snapshots[next(frames) % 2]
+            ui.refresh_display()
+
+        render()
+        return median_time(render, repeat)
+    finally:
+        ui.close()
+
+
+def bench_tick(window, options, repeat, tubes):
+    """
+    The median time of a whole tick as the display runs one --
+    collecting, publishing the snapshot and drawing it -- and the peak
+    bytes per tube allocated during one. The peak includes the fake
+    server's replies, which are built in this process.
+    """
+    ui = beanstalktop.BeanstalkTopUI(window, options)
+    tube_ids = [beanstalktop.TubeIds()]
+
+    def tick():
+        overview, lines = ui.collect()
+        snapshot = beanstalktop.freeze_snapshot(overview, lines, time.monotonic(), tube_ids[0])
+        tube_ids[0] = snapshot.table.tube_ids
+        ui.collector.snapshot = snapshot
+        ui.refresh_display()
+
+    try:
+        tick()
+        duration = median_time(tick, repeat)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tick()
+        peak = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        return duration, peak / tubes
+    finally:
+        ui.close()
+
+
+def bench_memory(window, options, tubes):
+    """
+    Bytes allocated and still held per tube after a monitor has
+    collected twice and a display has drawn the result.
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    ui = beanstalktop.BeanstalkTopUI(window, options)
+    tube_ids = beanstalktop.TubeIds()
+    for _ in range(2):
+        overview, lines = ui.collect()
+        ui.collector.snapshot = beanstalktop.freeze_snapshot(
+            overview, lines, time.monotonic(), tube_ids)
+        ui.refresh_display()
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    ui.close()
+    return held / tubes
+
+
+def bench_screen(window, tubes, latency, jitter, args, repeat):
+    """
+    The render, tick and held memory measurements, which draw, against
+    a fake server of this process's own.
+    """
+    fake = FakeBeanstalkd(tubes, latency, jitter).start()
+    try:
+        options = make_options(fake.address, args)
+        tick, peak = bench_tick(window, options, repeat, tubes)
+        return (bench_render(window, options, repeat), tick, peak,
+                bench_memory(window, options, tubes))
+    finally:
+        fake.stop()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--tubes',
+                      dest="tubes",
+                      default='10,1000,10000',
+                      help="comma separated tube counts to measure [10,1000,10000]"
+                      )
+    parser.add_option('--latency',
+                      dest="latency",
+                      default=0.0,
+                      type="float",
+                      metavar='NUM',
+                      help="seconds the fake server waits before each reply [0]"
+                      )
+    parser.add_option('--jitter',
+                      dest="jitter",
+                      default=0.0,
+                      type="float",
+                      metavar='NUM',
+                      help="up to this many more seconds added to each reply at random [0]"
+                      )
+    parser.add_option('--repeat',
+                      dest="repeat",
+                      default=5,
+                      type="int",
+                      metavar='NUM',
+                      help="runs of each measurement to take the median of [5]"
+                      )
+    parser.add_option('--no-pipeline',
+                      dest="pipeline",
+                      default=True,
+                      action="store_false",
+                      help="collect with one stats-tube at a time"
+                      )
+
+    options, args = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments: ' + ' '.join(args))
+
+    args = [] if options.pipeline else ['--no-pipeline']
+    print('{0:>8} {1:>12} {2:>12} {3:>12} {4:>12} {5:>12} {6:>12} {7:>12}'.format(
+        'tubes', 'collect ms', 'parse ms', 'inspect ms', 'render ms', 'tick ms', 'peak B/tube',
+        'bytes/tube'))
+    for tubes in [int(count) for count in options.tubes.split(',')]:
+        # Fork for the terminal before this process has any threads.
+        render, tick, peak, held = on_terminal(
+            bench_screen, tubes, options.latency, options.jitter, args, options.repeat)
+        fake = FakeBeanstalkd(tubes, options.latency, options.jitter).start()
+        try:
+            ui_options = make_options(fake.address, args)
+            print('{0:>8} {1:>12.2f} {2:>12.2f} {3:>12.2f} {4:>12.2f} {5:>12.2f} {6:>12.0f} {7:>12.0f}'.format(
+                tubes,
+                bench_collect(ui_options, options.repeat) * 1000.0,
+                bench_parse(fake, options.repeat) * 1000.0,
+                bench_inspect(ui_options, options.repeat) * 1000.0,
+                render * 1000.0,
+                tick * 1000.0,
+                peak,
+                held))
+        finally:
+            fake.stop()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -22,8 +22,11 @@ setup(
         ],
     },
     py_modules=['beanstalktop'],
+    python_requires='>=3.7',
     install_requires=[
-        'beanstalkc',
-        'PyYAML',
+        'beanstalkc3',
     ],
+    extras_require={
+        'pyyaml': ['PyYAML'],
+    },
 )
@@ -0,0 +1,124 @@
+"""
+AlertEngine: clear thresholds, `for` holds and cooldowns.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beanstalktop
+
+
+
+class AlertEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tube_ids = beanstalktop.TubeIds()
+
+
+    def engine(self, *args, **kwargs):
+        return beanstalktop.AlertEngine([beanstalktop.AlertRule('buried', *args, **kwargs)])
+
+
+    def update(self, engine, now, buried, overview=None):
+        """
+        The (kind, tube) events of one tick in which tube 'a' has
+        `buried` buried jobs and tube 'b' none.
+        """
+        lines = [{'name': 'a', 'current-jobs-buried': buried},
+                 {'name': 'b', 'current-jobs-buried': 0}]
+        table = beanstalktop.TubeTable.from_lines(lines, self.tube_ids)
+        self.tube_ids = table.tube_ids
+        return [(kind, tube) for kind, _, tube, _ in engine.update(overview or {}, table, now)]
+
+
+    def test_fires_and_resolves(self):
+        engine = self.engine('current-jobs-buried', '>', '10')
+        self.assertEqual(self.update(engine, 0, 5), [])
+        self.assertEqual(self.update(engine, 1, 20), [('firing', 'a')])
+        self.assertEqual(engine.firing, frozenset(['a']))
+        self.assertEqual(self.update(engine, 2, 30), [])
+        self.assertEqual(self.update(engine, 3, 5), [('resolved', 'a')])
+        self.assertEqual(engine.firing, frozenset())
+
+
+    def test_clear_threshold(self):
+        engine = self.engine('current-jobs-buried', '>', '10', clear='5')
+        self.assertEqual(self.update(engine, 0, 20), [('firing', 'a')])
+        # Below the trigger but above clear: still firing.
+        self.assertEqual(self.update(engine, 1, 8), [])
+        self.assertEqual(self.update(engine, 2, 11), [])
+        self.assertEqual(engine.firing, frozenset(['a']))
+        self.assertEqual(self.update(engine, 3, 4), [('resolved', 'a')])
+        # Not firing, so the trigger applies again.
+        self.assertEqual(self.update(engine, 4, 8), [])
+
+
+    def test_for_hold(self):
+        engine = self.engine('current-jobs-buried', '>', '10', hold=5.0)
+        self.assertEqual(self.update(engine, 0, 20), [])
+        self.assertEqual(self.update(engine, 4, 20), [])
+        self.assertEqual(self.update(engine, 5, 20), [('firing', 'a')])
+
+
+    def test_for_hold_runs_down_without_changes(self):
+        engine = self.engine('current-jobs-buried', '>', '10', hold=5.0)
+        self.assertEqual(self.update(engine, 0, 20), [])
+        # The same table again: nothing changed, but the hold is over.
+        self.assertEqual(self.update(engine, 6, 20), [('firing', 'a')])
+
+
+    def test_for_hold_broken(self):
+        engine = self.engine('current-jobs-buried', '>', '10', hold=5.0)
+        self.assertEqual(self.update(engine, 0, 20), [])
+        self.assertEqual(self.update(engine, 3, 5), [])
+        self.assertEqual(self.update(engine, 4, 20), [])
+        self.assertEqual(self.update(engine, 8, 20), [])
+        self.assertEqual(self.update(engine, 9, 20), [('firing', 'a')])
+
+
+    def test_cooldown(self):
+        engine = self.engine('current-jobs-buried', '>', '10', cooldown=10.0)
+        self.assertEqual(self.update(engine, 0, 20), [('firing', 'a')])
+        self.assertEqual(self.update(engine, 1, 5), [('resolved', 'a')])
+        # Firing again within the cooldown is not notified...
+        self.assertEqual(self.update(engine, 2, 20), [])
+        self.assertEqual(engine.firing, frozenset(['a']))
+        # ...nor is it resolving, since nobody heard it fire.
+        self.assertEqual(self.update(engine, 3, 5), [])
+        self.assertEqual(self.update(engine, 10, 20), [('firing', 'a')])
+
+
+    def test_notifications_forgotten_after_cooldown(self):
+        engine = self.engine('current-jobs-buried', '>', '10', cooldown=10.0)
+        self.update(engine, 0, 20)
+        self.update(engine, 1, 5)
+        self.assertEqual(list(engine._notified[0]), ['a'])
+        self.update(engine, 9, 5)
+        self.assertEqual(list(engine._notified[0]), ['a'])
+        self.update(engine, 10, 5)
+        self.assertEqual(engine._notified[0], {})
+
+
+    def test_tube_leaving_resolves(self):
+        engine = self.engine('current-jobs-buried', '>', '10')
+        self.assertEqual(self.update(engine, 0, 20), [('firing', 'a')])
+        table = beanstalktop.TubeTable.from_lines([{'name': 'b', 'current-jobs-buried': 0}], self.tube_ids)
+        events = engine.update({}, table, 1)
+        self.assertEqual([(kind, tube) for kind, _, tube, _ in events], [('resolved', 'a')])
+
+
+    def test_server_rule(self):
+        engine = self.engine('current-jobs-reserved', '>=', 'current-workers', server=True)
+        overview = {'current-jobs-reserved': 2, 'current-workers': 3}
+        self.assertEqual(self.update(engine, 0, 0, overview), [])
+        overview = {'current-jobs-reserved': 3, 'current-workers': 3}
+        self.assertEqual(self.update(engine, 1, 0, overview), [('firing', '*')])
+        self.assertEqual(engine.server_alerts(), ['buried'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
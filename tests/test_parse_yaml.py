@@ -0,0 +1,181 @@
+"""
+parse_yaml against yaml.safe_load over the replies beanstalkd sends.
+"""
+
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beanstalktop
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+
+STATS = """---
+current-jobs-urgent: 0
+current-jobs-ready: 12
+current-jobs-reserved: 3
+current-jobs-delayed: 1
+current-jobs-buried: 2
+cmd-put: 1204
+cmd-peek: 0
+cmd-peek-ready: 0
+cmd-peek-delayed: 0
+cmd-peek-buried: 0
+cmd-reserve: 1190
+cmd-reserve-with-timeout: 0
+cmd-delete: 1180
+cmd-release: 4
+cmd-use: 7
+cmd-watch: 7
+cmd-ignore: 0
+cmd-bury: 2
+cmd-kick: 0
+cmd-touch: 0
+cmd-stats: 31
+cmd-stats-job: 0
+cmd-stats-tube: 210
+cmd-list-tubes: 30
+cmd-list-tube-used: 0
+cmd-list-tubes-watched: 0
+cmd-pause-tube: 0
+job-timeouts: 1
+total-jobs: 1204
+max-job-size: 65535
+current-tubes: 7
+current-connections: 9
+current-producers: 2
+current-workers: 3
+current-waiting: 1
+total-connections: 40
+pid: 4121
+version: "1.12"
+rusage-utime: 0.148000
+rusage-stime: 0.332000
+uptime: 86461
+binlog-oldest-index: 0
+binlog-current-index: 0
+binlog-records-migrated: 0
+binlog-records-written: 0
+binlog-max-size: 10485760
+draining: false
+id: 3d3b8e2f6a1c9d4e
+hostname: queue-01
+os: #1 SMP PREEMPT_DYNAMIC
+platform: x86_64
+"""
+
+STATS_TUBE = """---
+name: emails
+current-jobs-urgent: 0
+current-jobs-ready: 12
+current-jobs-reserved: 3
+current-jobs-delayed: 1
+current-jobs-buried: 2
+total-jobs: 1204
+current-using: 2
+current-watching: 3
+current-waiting: 1
+cmd-delete: 1180
+cmd-pause-tube: 0
+pause: 0
+pause-time-left: 0
+"""
+
+LIST_TUBES = """---
+- default
+- emails
+- thumbnails.large
+- reports-2024
+"""
+
+# Scalars with a YAML 1.1 reading of their own.
+SCALARS = (
+    '0', '-3', '+4', '017', '08', '1_000', '0x1F', '0b101', '1:30',
+    '1.5', '1.50', '3.', '.5', '1.0e5', '1.0e+5', '1e5', '1:30.5',
+    '.inf', '-.inf', '.nan', 'yes', 'No', 'off', '~', 'null', '',
+    '"1.12"', 'abc', '0o17', '#1 SMP', '5 # five', 'a#b',
+    )
+
+
+
+def same(a, b):
+    if isinstance(a, float) and isinstance(b, float) and math.isnan(a):
+        return math.isnan(b)
+    return type(a) is type(b) and a == b
+
+
+
+@unittest.skipIf(yaml is None, 'PyYAML is not installed')
+class ParseYamlConformanceTest(unittest.TestCase):
+
+    def assertSameAsPyYAML(self, body):
+        ours, theirs = beanstalktop.parse_yaml(body), yaml.safe_load(body)
+        self.assertEqual(type(ours), type(theirs))
+        if isinstance(ours, list):
+            ours, theirs = dict(enumerate(ours)), dict(enumerate(theirs))
+        self.assertEqual(sorted(ours), sorted(theirs))
+        for key in ours:
+            self.assertTrue(same(ours[key], theirs[key]),
+                            '{0}: {1!r} != {2!r}'.format(key, ours[key], theirs[key]))
+
+
+    def test_stats(self):
+        self.assertSameAsPyYAML(STATS)
+
+
+    def test_stats_tube(self):
+        self.assertSameAsPyYAML(STATS_TUBE)
+
+
+    def test_list_tubes(self):
+        self.assertSameAsPyYAML(LIST_TUBES)
+
+
+    def test_bytes(self):
+        self.assertEqual(beanstalktop.parse_yaml(STATS.encode('ascii')), beanstalktop.parse_yaml(STATS))
+
+
+    def test_scalars(self):
+        for scalar in SCALARS:
+            ours = beanstalktop.parse_yaml('---\nkey: {0}\n'.format(scalar))['key']
+            theirs = yaml.safe_load('---\nkey: {0}\n'.format(scalar))['key']
+            self.assertTrue(same(ours, theirs), '{0}: {1!r} != {2!r}'.format(scalar, ours, theirs))
+
+
+
+class ParseYamlTubeNameTest(unittest.TestCase):
+    """
+    Where parse_yaml means to differ: a tube's name is its name.
+    """
+
+    names = ('007', '42', 'yes', '1.50', '0x1F', '~')
+
+    def test_list_tubes(self):
+        body = '---\n' + ''.join('- {0}\n'.format(name) for name in self.names)
+        self.assertEqual(beanstalktop.parse_yaml(body), list(self.names))
+
+
+    def test_stats_tube_name(self):
+        for name in self.names:
+            self.assertEqual(beanstalktop.parse_yaml('---\nname: {0}\npause: 0\n'.format(name)),
+                             {'name': name, 'pause': 0})
+
+
+    @unittest.skipIf(yaml is None, 'PyYAML is not installed')
+    def test_pyyaml(self):
+        body = '---\n' + ''.join('- {0}\n'.format(name) for name in self.names)
+        self.assertEqual(beanstalktop.parse_pyyaml(body), list(self.names))
+        self.assertEqual(beanstalktop.parse_pyyaml('---\nname: 007\npause: 0\n'), {'name': '007', 'pause': 0})
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Put and delete rates across ticks, counter resets and server restarts.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beanstalktop
+
+
+
+class CounterRateTest(unittest.TestCase):
+
+    def test_rate(self):
+        self.assertEqual(beanstalktop.counter_rate(30, 10, 2.0), 10.0)
+
+
+    def test_reset_counts_from_zero(self):
+        self.assertEqual(beanstalktop.counter_rate(4, 100, 2.0), 2.0)
+
+
+    def test_no_rate(self):
+        self.assertEqual(beanstalktop.counter_rate('-', 10, 2.0), '-')
+        self.assertEqual(beanstalktop.counter_rate(None, 10, 2.0), '-')
+        self.assertEqual(beanstalktop.counter_rate(30, 10, 0), '-')
+
+
+
+class HostRatesTest(unittest.TestCase):
+
+    def setUp(self):
+        options, _ = beanstalktop.make_parser().parse_args([])
+        options.tube_filter = beanstalktop.TubeFilter()
+        options.instruments = beanstalktop.Instruments()
+        self.host = beanstalktop.BeanstalkHost('localhost', 11300, options)
+
+
+    def tick(self, now, pid, uptime, puts, tubes, **kwargs):
+        """
+        Rates after a collection at `now` that saw `puts` server-wide
+        and (name, total-jobs, cmd-delete) for each tube.
+        """
+        overview = {'pid': pid, 'uptime': uptime, 'cmd-put': puts, 'cmd-delete': 0, 'cmd-bury': 0}
+        lines = [{'name': name, 'total-jobs': jobs, 'cmd-delete': deletes, 'current-jobs-ready': 0}
+                 for name, jobs, deletes in tubes]
+        self.host._add_rates(overview, lines, now, **kwargs)
+        return overview['put-rate'], dict((line['name'], (line['put-rate'], line['delete-rate'])) for line in lines)
+
+
+    def test_first_tick_has_no_rates(self):
+        self.assertEqual(self.tick(0.0, 1, 100, 50, [('a', 50, 10)]), ('-', {'a': ('-', '-')}))
+
+
+    def test_rates(self):
+        self.tick(0.0, 1, 100, 50, [('a', 50, 10)])
+        self.assertEqual(self.tick(2.0, 1, 102, 70, [('a', 70, 14)]), (10.0, {'a': (10.0, 2.0)}))
+
+
+    def test_new_tube(self):
+        self.tick(0.0, 1, 100, 50, [('a', 50, 10)])
+        # A tube new in the interval did all its work within it.
+        self.assertEqual(self.tick(2.0, 1, 102, 56, [('a', 50, 10), ('b', 6, 2)]),
+                         (3.0, {'a': (0.0, 0.0), 'b': (3.0, 1.0)}))
+
+
+    def test_tube_counter_reset(self):
+        self.tick(0.0, 1, 100, 50, [('a', 50, 10)])
+        # The tube was deleted and made again within the interval.
+        self.assertEqual(self.tick(2.0, 1, 102, 54, [('a', 4, 2)]), (2.0, {'a': (2.0, 1.0)}))
+
+
+    def test_restart(self):
+        self.tick(0.0, 1, 100, 500, [('a', 500, 100)])
+        # A new pid: everything counted since the restart 2s ago.
+        self.assertEqual(self.tick(10.0, 2, 2, 8, [('a', 8, 4)]), (4.0, {'a': (4.0, 2.0)}))
+        self.assertEqual(self.tick(12.0, 2, 4, 12, [('a', 12, 4)]), (2.0, {'a': (2.0, 0.0)}))
+
+
+    def test_restart_same_pid(self):
+        self.tick(0.0, 1, 100, 500, [('a', 500, 100)])
+        # A lower uptime means a restart too, even with the same pid.
+        self.assertEqual(self.tick(10.0, 1, 4, 600, [('a', 600, 100)]), (150.0, {'a': (150.0, 25.0)}))
+
+
+    def test_filter_changed(self):
+        self.tick(0.0, 1, 100, 50, [('a', 50, 10)])
+        # A tube just let in by a new filter has nothing to compare with.
+        self.assertEqual(self.tick(2.0, 1, 102, 70, [('a', 70, 10), ('b', 40, 0)], filter_changed=True),
+                         (10.0, {'a': (10.0, 0.0), 'b': ('-', '-')}))
+
+
+    def test_partial_rates_over_each_tubes_own_span(self):
+        self.tick(0.0, 1, 100, 0, [('a', 0, 0), ('b', 0, 0)], listed=['a', 'b'])
+        self.tick(2.0, 1, 102, 0, [('a', 10, 0)], listed=['a', 'b'])
+        # 'b' was last polled 4s ago, 'a' 2s ago.
+        self.assertEqual(self.tick(4.0, 1, 104, 0, [('a', 20, 0), ('b', 8, 0)], listed=['a', 'b'])[1],
+                         {'a': (5.0, 0.0), 'b': (2.0, 0.0)})
+
+
+
+if __name__ == '__main__':
+    unittest.main()
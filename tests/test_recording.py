@@ -0,0 +1,113 @@
+"""
+Recordings written by SessionRecorder: the key frame index, the frames
+read back from it, and seeking a replay.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beanstalktop
+
+
+
+def tick_state(tick):
+    overview = {'pid': 1, 'total-jobs': tick * 10}
+    lines = [{'name': 'tube{0}'.format(i), 'current-jobs-ready': tick + i}
+             for i in range(tick % 4 + 1)]
+    return overview, lines
+
+
+
+class RecordingTest(unittest.TestCase):
+
+    ticks = 10
+    key_interval = 3
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'session.rec')
+        recorder = beanstalktop.SessionRecorder(self.path, key_interval=self.key_interval)
+        for tick in range(self.ticks):
+            overview, lines = tick_state(tick)
+            recorder.write(100.0 + tick, overview, lines, 'tick {0}'.format(tick))
+        recorder.close()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def open(self):
+        recording = beanstalktop.Recording(self.path)
+        self.addCleanup(recording.close)
+        return recording
+
+
+    def frame_times(self, recording, offset):
+        return [(timestamp, kind) for timestamp, kind, _ in recording.frames(offset)]
+
+
+    def test_start_and_end(self):
+        recording = self.open()
+        self.assertEqual((recording.start, recording.end), (100.0, 100.0 + self.ticks - 1))
+
+
+    def test_key_frame_before(self):
+        recording = self.open()
+        for target, key in ((99.0, 100.0), (100.0, 100.0), (102.5, 100.0),
+                            (103.0, 103.0), (108.0, 106.0), (500.0, 109.0)):
+            frames = self.frame_times(recording, recording.key_frame_before(target))
+            self.assertEqual(frames[0], (key, beanstalktop.RECORD_KEY), target)
+
+
+    def test_frames_in_order(self):
+        recording = self.open()
+        frames = self.frame_times(recording, recording.key_frame_before(0))
+        self.assertEqual([timestamp for timestamp, _ in frames],
+                         [100.0 + tick for tick in range(self.ticks)])
+        self.assertEqual([kind == beanstalktop.RECORD_KEY for _, kind in frames],
+                         [tick % self.key_interval == 0 for tick in range(self.ticks)])
+
+
+    def test_index_rebuilt_when_missing(self):
+        with_index = self.open()
+        expected = [with_index.key_frame_before(100.0 + tick) for tick in range(self.ticks)]
+        os.unlink(self.path + '.idx')
+        recording = self.open()
+        self.assertEqual([recording.key_frame_before(100.0 + tick) for tick in range(self.ticks)], expected)
+
+
+    def test_truncated_frame_ends_recording(self):
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        recording = self.open()
+        self.assertEqual(len(self.frame_times(recording, recording.key_frame_before(0))), self.ticks - 1)
+
+
+    def test_not_a_recording(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'something else')
+        self.assertRaises(ValueError, beanstalktop.Recording, self.path)
+
+
+    def test_seek(self):
+        recording = self.open()
+        history = beanstalktop.History(60, 300.0)
+        replay = beanstalktop.ReplayCollector(recording, history, beanstalktop.TubeFilter())
+        for tick in range(self.ticks):
+            replay._seek(100.0 + tick + 0.5)
+            overview, lines = tick_state(tick)
+            self.assertEqual(replay._overview, overview)
+            self.assertEqual(replay._rows, dict((line['name'], line) for line in lines))
+            self.assertEqual(replay._status, 'tick {0}'.format(tick))
+            self.assertEqual(replay.position, 100.0 + tick + 0.5)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
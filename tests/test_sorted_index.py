@@ -0,0 +1,95 @@
+"""
+SortedIndex kept up to date a few rows at a time against a full sort.
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beanstalktop
+
+
+
+def make_lines(rnd, names):
+    lines = []
+    for name in names:
+        line = {'name': name,
+                'current-jobs-ready': rnd.choice([0, 0, 1, 5, 5, 40, 300]),
+                'put-rate': rnd.choice([0.0, 0.5, 2.5, '-'])}
+        lines.append(line)
+    return lines
+
+
+
+class SortedIndexTest(unittest.TestCase):
+
+    def assertSameOrder(self, index, table):
+        full = beanstalktop.SortedIndex(index.column, index.descending)
+        full.update(table)
+        self.assertEqual(index.head(len(table.rows)), full.head(len(table.rows)))
+
+
+    def check(self, column, descending, seed):
+        rnd = random.Random(seed)
+        universe = ['tube{0}'.format(i) for i in range(200)]
+        names = universe[:150]
+        lines = make_lines(rnd, names)
+        lines.insert(0, dict(beanstalktop.DEFAULT_ROW, name='h:1', **{'host-row': True}))
+
+        index = beanstalktop.SortedIndex(column, descending)
+        tube_ids = beanstalktop.TubeIds()
+        for tick in range(40):
+            table = beanstalktop.TubeTable.from_lines(lines, tube_ids)
+            tube_ids = table.tube_ids
+            index.update(table)
+            self.assertSameOrder(index, table)
+
+            # A few rows change, and now and then a tube comes or goes.
+            lines = [dict(line) for line in lines]
+            for line in rnd.sample(lines[1:], 5):
+                line.update(make_lines(rnd, [line['name']])[0])
+            if rnd.random() < 0.3:
+                del lines[rnd.randrange(1, len(lines))]
+            if rnd.random() < 0.3:
+                listed = set(line['name'] for line in lines)
+                lines.extend(make_lines(rnd, [rnd.choice([n for n in universe if n not in listed])]))
+
+
+    def test_descending(self):
+        for seed in range(5):
+            self.check('current-jobs-ready', True, seed)
+
+
+    def test_ascending(self):
+        for seed in range(5):
+            self.check('current-jobs-ready', False, seed)
+
+
+    def test_missing_values_last(self):
+        for seed in range(5):
+            self.check('put-rate', True, seed)
+
+
+    def test_name(self):
+        for seed in range(3):
+            self.check('name', True, seed)
+            self.check('name', False, seed)
+
+
+    def test_host_rows_first(self):
+        lines = [{'name': 'a', 'current-jobs-ready': 9},
+                 {'name': 'h:1', 'current-jobs-ready': 1, 'host-row': True},
+                 {'name': 'b', 'current-jobs-ready': '-'},
+                 {'name': 'c', 'current-jobs-ready': 9}]
+        table = beanstalktop.TubeTable.from_lines(lines, beanstalktop.TubeIds())
+        index = beanstalktop.SortedIndex('current-jobs-ready', True)
+        index.update(table)
+        self.assertEqual([table.names[tube_id] for tube_id in index.head(4)], ['h:1', 'a', 'c', 'b'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+state_delta and apply_state_delta, which the relay and --record use to
+send only what changed from one tick to the next.
+"""
+
+import copy
+import json
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beanstalktop
+
+
+
+def random_state(rnd):
+    overview = dict((key, rnd.choice([0, 1, 7, '-'])) for key in ('pid', 'total-jobs', 'put-rate'))
+    if rnd.random() < 0.5:
+        overview['probe-total'] = '1.2ms'
+    rows = {}
+    for i in range(rnd.randint(0, 12)):
+        name = 'tube{0}'.format(rnd.randint(0, 20))
+        rows[name] = dict((key, rnd.choice([0, 3, 2.5, '-', 'growing']))
+                          for key in rnd.sample(list(beanstalktop.DEFAULT_ROW), 4))
+        rows[name]['name'] = name
+    return overview, rows
+
+
+
+class StateDeltaTest(unittest.TestCase):
+
+    def assertRoundTrip(self, previous, current):
+        # Deltas are sent as JSON, so they must survive it.
+        message = json.loads(json.dumps(beanstalktop.state_delta(previous, current)))
+        overview, rows = copy.deepcopy(previous)
+        beanstalktop.apply_state_delta(overview, rows, message)
+        self.assertEqual((overview, rows), current)
+
+
+    def test_random_round_trips(self):
+        rnd = random.Random(0)
+        previous = ({}, {})
+        for _ in range(500):
+            current = random_state(rnd)
+            self.assertRoundTrip(previous, current)
+            previous = current
+
+
+    def test_from_nothing(self):
+        self.assertRoundTrip(({}, {}), ({'pid': 1}, {'a': {'name': 'a', 'current-jobs-ready': 2}}))
+
+
+    def test_to_nothing(self):
+        self.assertRoundTrip(({'pid': 1}, {'a': {'name': 'a', 'current-jobs-ready': 2}}), ({}, {}))
+
+
+    def test_unchanged_is_empty(self):
+        state = ({'pid': 1}, {'a': {'name': 'a', 'current-jobs-ready': 2}})
+        message = beanstalktop.state_delta(state, copy.deepcopy(state))
+        self.assertEqual(message, {'overview': ({}, []), 'rows': {}, 'removed': []})
+
+
+    def test_only_changes_sent(self):
+        previous = ({'pid': 1, 'put-rate': 0.5},
+                    {'a': {'name': 'a', 'current-jobs-ready': 2},
+                     'b': {'name': 'b', 'current-jobs-ready': 4}})
+        current = ({'pid': 1, 'put-rate': 1.0},
+                   {'a': {'name': 'a', 'current-jobs-ready': 3}})
+        message = beanstalktop.state_delta(previous, current)
+        self.assertEqual(message['overview'], ({'put-rate': 1.0}, []))
+        self.assertEqual(message['rows'], {'a': ({'current-jobs-ready': 3}, [])})
+        self.assertEqual(message['removed'], ['b'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
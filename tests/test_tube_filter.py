@@ -0,0 +1,88 @@
+"""
+TubeFilter: globs, re: patterns and the prompt syntax.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import beanstalktop
+
+
+
+NAMES = ['default', 'emails', 'emails.bulk', 'thumbs.large', 'thumbs.small', 'reports-2024', '007']
+
+
+
+class TubeFilterTest(unittest.TestCase):
+
+    def select(self, include=(), exclude=()):
+        return beanstalktop.TubeFilter(include, exclude).select(NAMES)
+
+
+    def test_no_patterns(self):
+        tube_filter = beanstalktop.TubeFilter()
+        self.assertFalse(tube_filter)
+        self.assertIs(tube_filter.select(NAMES), NAMES)
+
+
+    def test_glob_matches_whole_name(self):
+        self.assertEqual(self.select(['emails']), ['emails'])
+        self.assertEqual(self.select(['emails*']), ['emails', 'emails.bulk'])
+        self.assertEqual(self.select(['thumbs.?????']), ['thumbs.large', 'thumbs.small'])
+        self.assertEqual(self.select(['*.[ls]*']), ['thumbs.large', 'thumbs.small'])
+
+
+    def test_glob_dot_is_literal(self):
+        self.assertEqual(self.select(['emails.bul?']), ['emails.bulk'])
+        self.assertEqual(self.select(['emails?bulk']), ['emails.bulk'])
+        self.assertEqual(beanstalktop.TubeFilter(['a.b']).select(['a.b', 'axb']), ['a.b'])
+
+
+    def test_regex_matches_anywhere(self):
+        self.assertEqual(self.select(['re:mail']), ['emails', 'emails.bulk'])
+        self.assertEqual(self.select(['re:^thumbs\\.']), ['thumbs.large', 'thumbs.small'])
+        self.assertEqual(self.select(['re:-\\d+$']), ['reports-2024'])
+
+
+    def test_several_includes(self):
+        self.assertEqual(self.select(['default', 're:large']), ['default', 'thumbs.large'])
+
+
+    def test_exclude(self):
+        self.assertEqual(self.select(exclude=['thumbs.*']),
+                         ['default', 'emails', 'emails.bulk', 'reports-2024', '007'])
+        self.assertEqual(self.select(['emails*', 'thumbs.*'], ['re:bulk|small']),
+                         ['emails', 'thumbs.large'])
+
+
+    def test_numeric_names(self):
+        tube_filter = beanstalktop.TubeFilter(['0*'])
+        self.assertTrue(tube_filter.matches('007'))
+        self.assertTrue(tube_filter.matches(7) is False)
+
+
+    def test_parse(self):
+        tube_filter = beanstalktop.TubeFilter.parse('emails* re:thumbs !*.bulk')
+        self.assertEqual(tube_filter.include, ('emails*', 're:thumbs'))
+        self.assertEqual(tube_filter.exclude, ('*.bulk',))
+        self.assertEqual(str(tube_filter), 'emails* re:thumbs !*.bulk')
+        self.assertEqual(tube_filter.select(NAMES), ['emails', 'thumbs.large', 'thumbs.small'])
+
+
+    def test_bad_regex(self):
+        self.assertRaises(beanstalktop.re.error, beanstalktop.TubeFilter, ['re:('])
+
+
+    def test_filter_lines_keeps_host_rows(self):
+        lines = [{'name': 'h:1', 'host-row': True}, {'name': 'h:1/emails'}, {'name': 'h:1/default'}]
+        tube_filter = beanstalktop.TubeFilter(['emails'])
+        self.assertEqual([line['name'] for line in beanstalktop.filter_lines(tube_filter, lines)],
+                         ['h:1', 'h:1/emails'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()